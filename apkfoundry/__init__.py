@@ -33,6 +33,12 @@ CACHEDIR = Path(os.environ.get(
 )).resolve(strict=False)
 
 ROOTFS_CACHE = CACHEDIR / "rootfs"
+CONTAINER_POOL = LOCALSTATEDIR / "pool"
+SNAPSHOTS = LOCALSTATEDIR / "snapshots"
+CHANGES_CACHE = CACHEDIR / "changes"
+DEPS_CACHE = CACHEDIR / "deps"
+DISTFILES_CACHE = CACHEDIR / "distfiles"
+DURATIONS_CACHE = CACHEDIR / "durations"
 
 MOUNTS = {
     "aportsdir": "/af/aports",
@@ -79,6 +85,7 @@ _DEFAULT_SITE_CONFIG = {
     "container": {
         "subuid": "100000",
         "subgid": "100000",
+        "sessions": "false",
     },
     "setarch": {
     },
@@ -98,6 +105,7 @@ _DEFAULT_PROJ_CONFIG = {
         "build.networking": "false",
         "build.on-failure": "stop", # str
         "build.only-changed-versions": "false", # bool
+        "build.result-cache": "false", # bool
         "build.skip": "", # maplist
         "container.persistent-repodest": "false", # bool
         "deps.ignore": "", # maplist
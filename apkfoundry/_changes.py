@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import hashlib    # sha256
+import json       # dump, load
+import os         # getpid, replace
+import re         # compile
+import subprocess # run, PIPE
+from pathlib import Path
+
+import apkfoundry # CHANGES_CACHE
+
+_VERSION = 1
+_NULL_OID = re.compile(r"^0+$")
+_VERSION_LINE = re.compile(rb"^pkg(?:ver|rel)=.*$", re.MULTILINE)
+
+def _git(gitdir, *args, **kwargs):
+    return subprocess.run(
+        ("git", *gitdir, *args),
+        stdout=subprocess.PIPE, check=True, **kwargs,
+    ).stdout
+
+def _diff_tree(gitdir, revs):
+    """
+    Return a dictionary mapping each STARTDIR touched by the given
+    revisions to its APKBUILD's (old, new) blob IDs, or None if the
+    APKBUILD itself was not changed.
+    """
+    out = _git(
+        gitdir, "diff-tree", "-r", "-z", "--no-commit-id",
+        "--diff-filter", "xu", *revs, "--",
+    )
+    out = out.decode("utf-8").split("\0")
+
+    startdirs = {}
+    # Each record is ":OLDMODE NEWMODE OLDOID NEWOID STATUS\0PATH\0"
+    for meta, path in zip(out[0::2], out[1::2]):
+        path = path.split("/")
+        if len(path) < 3 or path[0].startswith("."):
+            continue
+        startdir = "/".join(path[:2])
+        if path[2:] == ["APKBUILD"]:
+            _, _, old, new, _ = meta.split()
+            startdirs[startdir] = (old, new)
+        else:
+            startdirs.setdefault(startdir, None)
+
+    return startdirs
+
+def _cat_blobs(gitdir, oids):
+    out = _git(
+        gitdir, "cat-file", "--batch",
+        input="".join(i + "\n" for i in oids).encode("utf-8"),
+    )
+
+    blobs = {}
+    for oid in oids:
+        header, out = out.split(b"\n", maxsplit=1)
+        size = int(header.split()[2])
+        blobs[oid] = out[:size]
+        out = out[size + 1:]
+
+    return blobs
+
+def _version_changed(gitdir, startdirs):
+    oids = set()
+    for blobs in startdirs.values():
+        if blobs:
+            oids.update(i for i in blobs if not _NULL_OID.match(i))
+    blobs = _cat_blobs(gitdir, sorted(oids)) if oids else {}
+
+    changed = []
+    for startdir, oids in startdirs.items():
+        if not oids:
+            continue
+        old, new = (
+            _VERSION_LINE.findall(blobs[i]) if i in blobs else None
+            for i in oids
+        )
+        # Completely new APKBUILDs are always built
+        if old is None or old != new:
+            changed.append(startdir)
+
+    return changed
+
+def _cache_file(gitdir, revs, only_versions):
+    oids = _git(gitdir, "rev-parse", *revs).decode("utf-8").split()
+    key = "\0".join((*oids, "only-versions" if only_versions else ""))
+    key = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return apkfoundry.CHANGES_CACHE / f"{key}.json"
+
+def _load_cache(cache_file):
+    try:
+        with open(cache_file, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cache.get("version") != _VERSION:
+        return None
+    return cache.get("startdirs")
+
+def _save_cache(cache_file, startdirs):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": _VERSION, "startdirs": startdirs}, f)
+    os.replace(tmp, cache_file)
+
+def changed_startdirs(aportsdir, rev_range, only_versions=False):
+    """
+    Return the STARTDIRs with any file changed in the given revision
+    range (as understood by git diff-tree). If only_versions is True,
+    only return STARTDIRs whose APKBUILD is new or has a different
+    pkgver or pkgrel. STARTDIRs without an APKBUILD in aportsdir are
+    omitted.
+    """
+    gitdir = ["-C", str(aportsdir)] if aportsdir else []
+    revs = rev_range.split()
+
+    cache_file = _cache_file(gitdir, revs, only_versions)
+    startdirs = _load_cache(cache_file)
+    if startdirs is None:
+        changes = _diff_tree(gitdir, revs)
+        if only_versions:
+            startdirs = _version_changed(gitdir, changes)
+        else:
+            startdirs = sorted(changes)
+        _save_cache(cache_file, startdirs)
+
+    aportsdir = Path(aportsdir or ".")
+    return [i for i in startdirs if (aportsdir / i / "APKBUILD").is_file()]
@@ -0,0 +1,144 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import concurrent.futures # as_completed, ThreadPoolExecutor
+import hashlib        # sha512
+import logging        # getLogger
+import os             # chmod, close, fdopen, link, pipe, replace, unlink
+import re             # compile
+import shutil         # copy2
+import tempfile       # mkstemp
+import urllib.parse   # urlsplit
+import urllib.request # urlopen
+
+import apkfoundry # DISTFILES_CACHE
+
+_LOGGER = logging.getLogger(__name__)
+_CHUNK = 1 << 16
+_TIMEOUT = 60
+_MAX_SIZE = 8 << 30
+_SCHEMES = ("http", "https", "ftp")
+_SHA512 = re.compile(r"^[0-9a-f]{128}$")
+
+def _store_path(sha512):
+    return apkfoundry.DISTFILES_CACHE / sha512[:2] / sha512
+
+def _list_sources(cont, startdirs):
+    read_fd, write_fd = os.pipe()
+
+    def run():
+        try:
+            rc, _ = cont.run(
+                ["/af/libexec/af-sources", *startdirs],
+                stdout=write_fd,
+                skip_refresh=True, skip_sudo=True,
+            )
+        finally:
+            os.close(write_fd)
+        return rc
+
+    sources = []
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        future = pool.submit(run)
+        with open(read_fd, encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n").split(" ", maxsplit=4)
+                if len(line) != 5 or line[0] != "s":
+                    _LOGGER.warning("Invalid af-sources output: %r", line)
+                    continue
+                sources.append(tuple(line[1:]))
+        rc = future.result()
+
+    return rc, sources
+
+def _fetch(url, sha512):
+    path = _store_path(sha512)
+    if path.is_file():
+        return path, False
+
+    scheme = urllib.parse.urlsplit(url).scheme.lower()
+    if scheme not in _SCHEMES:
+        raise ValueError(f"unsupported URL scheme {scheme!r}")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".", suffix=".part")
+    try:
+        digest = hashlib.sha512()
+        with os.fdopen(fd, "wb") as f, \
+                urllib.request.urlopen(url, timeout=_TIMEOUT) as response:
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > _MAX_SIZE:
+                raise ValueError("file is too large")
+
+            size = 0
+            for chunk in iter(lambda: response.read(_CHUNK), b""):
+                size += len(chunk)
+                if size > _MAX_SIZE:
+                    raise ValueError("file is too large")
+                digest.update(chunk)
+                f.write(chunk)
+
+        if digest.hexdigest() != sha512:
+            raise ValueError("sha512 does NOT match")
+
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    return path, True
+
+def _link(path, dest):
+    try:
+        os.link(path, dest)
+    except FileExistsError:
+        pass
+    except OSError:
+        # e.g. SRCDEST is on a different filesystem
+        shutil.copy2(path, dest)
+
+def prefetch(cont, startdirs, jobs=None):
+    rc, sources = _list_sources(cont, startdirs)
+    if rc:
+        _LOGGER.warning("af-sources failed; prefetching what was found")
+
+    srcdest = cont.cdir / "af/config/srcdest"
+    wanted = {}
+    for _, name, sha512, url in sources:
+        if not _SHA512.match(sha512) or "/" in name:
+            _LOGGER.warning("%s: skipping invalid source entry", name)
+            continue
+        dest = srcdest / name
+        if dest.exists() or dest in wanted:
+            continue
+        wanted[dest] = (url, sha512)
+
+    by_sum = {}
+    for dest, (url, sha512) in wanted.items():
+        by_sum.setdefault(sha512, (url, []))[1].append(dest)
+
+    downloaded = failed = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = {
+            pool.submit(_fetch, url, sha512): (url, dests)
+            for sha512, (url, dests) in by_sum.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            url, dests = futures[future]
+            try:
+                path, new = future.result()
+            except (OSError, ValueError) as e:
+                _LOGGER.warning("%s: %s", url, e)
+                failed += 1
+                continue
+
+            downloaded += new
+            for dest in dests:
+                _link(path, dest)
+
+    _LOGGER.info(
+        "%d source files needed, %d downloaded, %d failed",
+        len(by_sum), downloaded, failed,
+    )
+    return failed
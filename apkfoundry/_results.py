@@ -0,0 +1,147 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import hashlib # sha256
+import json    # dump, load
+import os      # getpid, replace, walk
+from pathlib import Path
+
+import apkfoundry # MOUNTS
+
+_VERSION = 1
+_CHUNK = 1 << 20
+
+def _hash_file(digest, path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            digest.update(chunk)
+
+class ResultCache:
+    """
+    Remember the inputs of every successful build in a REPODEST so that
+    builds whose inputs have not changed since can be skipped.
+
+    The fingerprint of a STARTDIR covers the contents of every file in
+    the STARTDIR, the fingerprints of its dependencies, the architecture,
+    and the build script.
+    """
+
+    __slots__ = (
+        "aportsdir",
+        "repodest",
+        "cache_file",
+        "graph",
+        "salt",
+        "fingerprints",
+        "results",
+    )
+
+    def __init__(self, cont, graph, script):
+        self.aportsdir = cont.cdir / "af/config/aportsdir"
+        self.repodest = cont.cdir / "af/config/repodest"
+        self.cache_file = self.repodest / ".af-results" / f"{cont.arch}.json"
+        self.graph = graph
+        self.fingerprints = {}
+
+        salt = hashlib.sha256()
+        salt.update(f"{_VERSION}\0{cont.arch}\0{script}\0".encode("utf-8"))
+        # The build script is given as a path inside the container
+        script = Path(script)
+        aports = Path(apkfoundry.MOUNTS["aportsdir"])
+        if aports in script.parents:
+            script = self.aportsdir / script.relative_to(aports)
+        elif script.is_absolute():
+            script = cont.cdir / script.relative_to("/")
+        else:
+            script = None
+        if script:
+            try:
+                _hash_file(salt, script)
+            except OSError:
+                pass
+        self.salt = salt.digest()
+
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            results = {}
+        if results.get("version") != _VERSION:
+            results = {}
+        self.results = results.get("startdirs", {})
+
+    def _fingerprint(self, startdir):
+        digest = hashlib.sha256(self.salt)
+        top = self.aportsdir / startdir
+        for dpath, dnames, fnames in os.walk(top):
+            dnames.sort()
+            for fname in sorted(fnames):
+                path = Path(dpath) / fname
+                digest.update(str(path.relative_to(top)).encode("utf-8"))
+                digest.update(b"\0")
+                _hash_file(digest, path)
+
+        for dep in sorted(self.graph.predecessors(startdir)):
+            digest.update(dep.encode("utf-8") + b"\0")
+            digest.update(self.fingerprints[dep].encode("utf-8"))
+
+        return digest.hexdigest()
+
+    def fingerprint(self, startdir):
+        """
+        Return the fingerprint of the given STARTDIR, computing the
+        fingerprints of its dependencies first if needed.
+        """
+        todo = [startdir]
+        while todo:
+            cur = todo[-1]
+            if cur in self.fingerprints:
+                todo.pop()
+                continue
+
+            deps = [
+                i for i in self.graph.predecessors(cur)
+                if i not in self.fingerprints
+            ]
+            if deps:
+                todo.extend(deps)
+                continue
+
+            todo.pop()
+            self.fingerprints[cur] = self._fingerprint(cur)
+
+        return self.fingerprints[startdir]
+
+    def lookup(self, startdir):
+        """
+        Return True if the given STARTDIR was previously built with the
+        same inputs and its packages are still in the REPODEST.
+        """
+        result = self.results.get(startdir)
+        if not result or result["fingerprint"] != self.fingerprint(startdir):
+            return False
+
+        return all((self.repodest / i).is_file() for i in result["files"])
+
+    def store(self, startdir, files):
+        """
+        Record that the given STARTDIR was built successfully and produced
+        the given files (relative to the REPODEST).
+        """
+        self.results[startdir] = {
+            "fingerprint": self.fingerprint(startdir),
+            "files": sorted(files),
+        }
+
+    def discard(self, startdir):
+        self.results.pop(startdir, None)
+
+    def save(self):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": _VERSION, "startdirs": self.results},
+                f, separators=(",", ":"),
+            )
+        os.replace(tmp, self.cache_file)
@@ -1,28 +1,57 @@
 # SPDX-License-Identifier: GPL-2.0-only
 # Copyright (c) 2018-2020 Max Rees
 # See LICENSE for more information.
+import fcntl          # flock, LOCK_EX
 import hashlib        # sha256
+import json           # dump, load
 import logging        # getLogger
-import mmap           # ACCESS_READ, mmap
-import resource       # getpagesize
-import shutil         # copyfileobj
+import os             # getpid, replace
+import urllib.error   # HTTPError
 import urllib.parse   # urlparse
-import urllib.request # urlopen
+import urllib.request # Request, urlopen
 from pathlib import Path
 
 import apkfoundry # ROOTFS_CACHE
 
 _LOGGER = logging.getLogger(__name__)
-_PAGESZ = resource.getpagesize()
+_CHUNK = 1 << 20
+
+def _verified_file(filename):
+    return filename.with_name(filename.name + ".sha256")
+
+def _stat_key(filename):
+    st = filename.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+def _is_verified(filename, sha256):
+    try:
+        with open(_verified_file(filename), encoding="utf-8") as f:
+            verified = json.load(f)
+        return verified == {"sha256": sha256, "stat": _stat_key(filename)}
+    except (OSError, ValueError):
+        return False
+
+def _mark_verified(filename, sha256):
+    verified = _verified_file(filename)
+    tmp = verified.with_name(verified.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"sha256": sha256, "stat": _stat_key(filename)}, f)
+    os.replace(tmp, verified)
+
+def _hash_into(digest, f):
+    chunk = f.read(_CHUNK)
+    while chunk:
+        digest.update(chunk)
+        chunk = f.read(_CHUNK)
 
 def _file_sha256(filename, old):
-    with open(filename, "r") as f:
-        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-            new = hashlib.sha256()
-            chunk = mm.read(_PAGESZ)
-            while chunk:
-                new.update(chunk)
-                chunk = mm.read(_PAGESZ)
+    if _is_verified(filename, old):
+        _LOGGER.info("%s: OK (cached)", filename.name)
+        return True
+
+    new = hashlib.sha256()
+    with open(filename, "rb") as f:
+        _hash_into(new, f)
 
     new = new.hexdigest()
     if old != new:
@@ -30,15 +59,61 @@ def _file_sha256(filename, old):
         filename.unlink()
         return False
 
+    _mark_verified(filename, new)
     _LOGGER.info("%s: OK", filename.name)
     return True
 
-def _download_rootfs(url, filename):
+def _download_rootfs(url, filename, sha256):
     apkfoundry.ROOTFS_CACHE.mkdir(parents=True, exist_ok=True)
-    _LOGGER.info("Downloading %s...", filename.name)
-    with open(filename, "wb") as f:
-        with urllib.request.urlopen(url) as response:
-            shutil.copyfileobj(response, f)
+    part = filename.with_name(filename.name + ".part")
+    digest = hashlib.sha256()
+
+    request = urllib.request.Request(url)
+    offset = part.stat().st_size if part.is_file() else 0
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        # The partial download is already complete
+        if not (offset and e.code == 416):
+            raise
+        response = None
+
+    if response is None:
+        with open(part, "rb") as f:
+            _hash_into(digest, f)
+    else:
+        with response:
+            if offset and getattr(response, "status", None) == 206:
+                _LOGGER.info(
+                    "Resuming download of %s at %d bytes...",
+                    filename.name, offset,
+                )
+                mode = "r+b"
+            else:
+                _LOGGER.info("Downloading %s...", filename.name)
+                mode = "wb"
+
+            with open(part, mode) as f:
+                if mode == "r+b":
+                    _hash_into(digest, f)
+                chunk = response.read(_CHUNK)
+                while chunk:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    chunk = response.read(_CHUNK)
+
+    if digest.hexdigest() != sha256:
+        _LOGGER.error("%s: sha256 does NOT match", filename.name)
+        part.unlink()
+        return False
+
+    os.replace(part, filename)
+    _mark_verified(filename, sha256)
+    _LOGGER.info("%s: OK", filename.name)
+    return True
 
 def _get_rootfs(conf, arch):
     url = conf.get("rootfs.url." + arch, "").strip()
@@ -59,30 +134,104 @@ def _get_rootfs(conf, arch):
 
     cached = apkfoundry.ROOTFS_CACHE / name
     if not cached.is_file():
-        _download_rootfs(url, cached)
-
-    if not _file_sha256(cached, sha256):
+        if not _download_rootfs(url, cached, sha256):
+            return None
+    elif not _file_sha256(cached, sha256):
         return None
 
     return cached
 
+def _cont_path(path):
+    return Path("/tmp/af/rootfs-cache") / path.relative_to(
+        apkfoundry.ROOTFS_CACHE
+    )
+
+def _make_template(cont, rootfs, template, exclusions):
+    tmp = template.with_name(f".{template.name}.{os.getpid()}")
+    rc, _ = cont.run_external(
+        (
+            "sh", "-ec",
+            """tmp="$1"; final="$2"; rootfs="$3"; shift 3
+            rm -rf "$tmp"
+            mkdir "$tmp"
+            tar -xf "$rootfs" -C "$tmp" "$@"
+            mv "$tmp" "$final"
+            """,
+            "sh", _cont_path(tmp), _cont_path(template), rootfs, *exclusions,
+        ),
+        rw_cache=True,
+    )
+    return rc
+
+def _prune_templates(cont, keep):
+    # Only the newest template of each architecture is kept. Templates
+    # that are being copied from are locked and left for next time
+    arch = keep.name.split("-", maxsplit=1)[0]
+    for template in keep.parent.glob(f"{arch}-*"):
+        if template == keep or not template.is_dir():
+            continue
+
+        lockfile = template.with_name(template.name + ".lock")
+        with open(lockfile, "a", encoding="utf-8") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+
+            _LOGGER.info("Removing stale rootfs template %s...", template.name)
+            rc, _ = cont.run_external(
+                ("rm", "-rf", _cont_path(template)),
+                rw_cache=True,
+            )
+            if rc:
+                _LOGGER.warning("Could not remove %s", template.name)
+                continue
+            lockfile.unlink()
+
 def extract_rootfs(cont, conf):
     rootfs = _get_rootfs(conf, cont.arch)
     if not rootfs:
         return 1
-    rootfs = Path("/tmp/af/rootfs-cache") / rootfs.relative_to(
-        apkfoundry.ROOTFS_CACHE
-    )
+    sha256 = conf.get("rootfs.sha256." + cont.arch).strip()
+    rootfs = _cont_path(rootfs)
 
     exclusions = [("--exclude", i) for i in conf.getlist("rootfs.exclude", [])]
     exclusions = [j for i in exclusions for j in i]
 
-    rc, _ = cont.run_external(
-        # Relative to CWD = cdir
-        ("tar", "-xf", rootfs, *exclusions),
-    )
-    if rc:
-        return rc
+    # Extracted trees are cached by tarball and exclusion list so that
+    # only the first container for each of them pays for decompression
+    key = hashlib.sha256("\0".join(exclusions).encode("utf-8"))
+    template = apkfoundry.ROOTFS_CACHE / "templates" \
+        / f"{cont.arch}-{sha256}-{key.hexdigest()[:16]}"
+    template.parent.mkdir(parents=True, exist_ok=True)
+
+    lockfile = template.with_name(template.name + ".lock")
+    with open(lockfile, "a", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not template.is_dir():
+            _LOGGER.info("Extracting %s...", rootfs.name)
+            rc = _make_template(cont, rootfs, template, exclusions)
+            if rc:
+                return rc
+            _prune_templates(cont, template)
+
+        # Keep a shared lock while copying so that the template is not
+        # pruned in the meantime
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        _LOGGER.info("Copying rootfs from %s...", template.name)
+        rc, _ = cont.run_external(
+            # Relative to CWD = cdir
+            ("cp", "-a", "--reflink=auto", f"{_cont_path(template)}/.", "."),
+        )
+        if rc:
+            # BusyBox cp does not support --reflink at all
+            _LOGGER.debug("cp --reflink failed, trying a plain copy")
+            rc, _ = cont.run_external(
+                # Relative to CWD = cdir
+                ("cp", "-a", f"{_cont_path(template)}/.", "."),
+            )
+        if rc:
+            return rc
 
     rc, _ = cont.run_external(
         # Relative to CWD = cdir
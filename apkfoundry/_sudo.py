@@ -4,19 +4,21 @@
 import errno        # EBADF
 import logging      # getLogger
 import os           # close, write
-import socket       # CMSG_SPACE, SOL_SOCKET, SCM_RIGHTS, socketpair
+import socket       # AF_UNIX, CMSG_SPACE, SCM_RIGHTS, SOCK_SEQPACKET,
+                    # SOL_SOCKET, socket, socketpair
 import socketserver # StreamRequestHandler
 import struct       # calcsize, pack, unpack
-import threading    # Thread
+import threading    # Lock, Thread
 from pathlib import Path
 
 import apkfoundry.container # Container
 
 _LOGGER = logging.getLogger(__name__)
 
-NUM_FDS = 3
-PASSFD_FMT = NUM_FDS * "i"
-PASSFD_SIZE = socket.CMSG_SPACE(struct.calcsize(PASSFD_FMT))
+# stdin, stdout, stderr, and the socket to send the reply to. Requests
+# with only the first three are answered over the main socket.
+NUM_FDS = 4
+PASSFD_SIZE = socket.CMSG_SPACE(struct.calcsize(NUM_FDS * "i"))
 RC_FMT = "i"
 BUF_SIZE = 4096
 
@@ -46,6 +48,14 @@ def apk(argv):
         if i in argv:
             raise ValueError("apkfoundry: apk: %s: not allowed option" % i)
 
+# Commands which may safely run at the same time as other privileged
+# commands in the same container. All other commands modify the apk
+# database or the user database and are serialized using _LOCK.
+_UNLOCKED = (
+    "abuild-fetch",
+)
+_LOCK = threading.Lock()
+
 COMMANDS = {
     "apk": ("/sbin/apk", apk),
     "abuild-apk": ("/sbin/apk", apk),
@@ -62,7 +72,7 @@ def recv_fds(conn):
     for cmsg in anc:
         if cmsg[0:2] != (socket.SOL_SOCKET, socket.SCM_RIGHTS):
             continue
-        fds = struct.unpack(PASSFD_FMT, cmsg[2])
+        fds = struct.unpack(len(cmsg[2]) // struct.calcsize("i") * "i", cmsg[2])
         break
     else:
         fds = tuple()
@@ -73,7 +83,7 @@ def send_retcode(conn, rc):
     conn.send(struct.pack(RC_FMT, rc))
 
 def client_init(cdir):
-    server, client = socket.socketpair()
+    server, client = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
     sudo_thread = threading.Thread(
         target=SudoConn,
         args=(server, cdir),
@@ -83,6 +93,14 @@ def client_init(cdir):
     sudo_thread.start()
     return client
 
+def _close_fds(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError as e:
+            if e.errno != errno.EBADF:
+                raise
+
 class SudoConn(socketserver.StreamRequestHandler):
     def __init__(self, sock, cdir):
         self.cdir = Path(cdir)
@@ -90,14 +108,15 @@ class SudoConn(socketserver.StreamRequestHandler):
 
     def setup(self):
         super().setup()
-        self.fds = [-1, -1, -1]
+        self.workers = []
+        # Shared by all requests so that the container metadata and
+        # mounts are only resolved once
+        self.cont = apkfoundry.container.Container(self.cdir, sudo=False)
 
     def handle(self):
         announced = False
 
         while True:
-            self._close_fds()
-
             try:
                 argv, fds = recv_fds(self.request)
             except ConnectionError:
@@ -105,70 +124,97 @@ class SudoConn(socketserver.StreamRequestHandler):
                 break
             if not argv:
                 _LOGGER.debug("Disconnected")
+                _close_fds(fds)
                 break
 
             if not announced:
                 _LOGGER.debug("Connected")
                 announced = True
 
-            if not fds:
-                self._err("No file descriptors given")
+            _close_fds(fds[NUM_FDS:])
+            fds = fds[:NUM_FDS]
+            if len(fds) < NUM_FDS:
+                # Legacy client: answer on the main socket, one request
+                # at a time
+                self._request(argv, fds, self.request)
                 continue
-            self.fds = list(fds)
 
-            argv = argv.decode("utf-8")
-            argv = argv.split("\0")
-            cmd = argv[0]
+            reply = socket.socket(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET, fileno=fds[3],
+            )
+            worker = threading.Thread(
+                target=self._request,
+                args=(argv, fds[:3], reply),
+                daemon=True,
+            )
+            worker.start()
+            self.workers = [i for i in self.workers if i.is_alive()]
+            self.workers.append(worker)
 
-            if cmd not in COMMANDS:
-                self._err("Command not allowed: %s", cmd)
-                continue
+    def _request(self, argv, fds, reply):
+        try:
+            self._handle_request(argv, fds, reply)
+        finally:
+            _close_fds(fds)
+            if reply is not self.request:
+                reply.close()
 
-            _LOGGER.debug("Received command: %s", " ".join(argv))
+    def _handle_request(self, argv, fds, reply):
+        if not fds:
+            self._err(fds, reply, "No file descriptors given")
+            return
 
-            try:
-                COMMANDS[cmd][1](argv[1:])
-            except ValueError as e:
-                self._err("%s", e)
-                continue
-            argv[0] = COMMANDS[cmd][0]
+        argv = argv.decode("utf-8")
+        argv = argv.split("\0")
+        cmd = argv[0]
 
-            try:
-                cont = apkfoundry.container.Container(self.cdir, sudo=False)
-                rc, _ = cont.run(
-                    argv,
-                    su=True, net=True, ro_root=False, skip_refresh=True,
-                    stdin=self.fds[0], stdout=self.fds[1], stderr=self.fds[2],
-                )
-
-                send_retcode(self.request, rc)
-            except ConnectionError:
-                pass
+        if cmd not in COMMANDS:
+            self._err(fds, reply, "Command not allowed: %s", cmd)
+            return
 
-    def finish(self):
-        self._close_fds()
+        _LOGGER.debug("Received command: %s", " ".join(argv))
 
-    def _close_fds(self):
-        for i, fd in enumerate(self.fds):
-            if fd == -1:
-                continue
-            try:
-                os.close(fd)
-            except OSError as e:
-                if e.errno != errno.EBADF:
-                    raise
-            self.fds[i] = -1
-
-    def _err(self, fmt, *args):
-        msg = fmt % args
+        try:
+            COMMANDS[cmd][1](argv[1:])
+        except ValueError as e:
+            self._err(fds, reply, "%s", e)
+            return
+        argv[0] = COMMANDS[cmd][0]
 
         try:
-            os.write(self.fds[2], msg.encode("utf-8") + b"\n")
-        except OSError:
+            if cmd in _UNLOCKED:
+                rc = self._run(argv, fds)
+            else:
+                with _LOCK:
+                    rc = self._run(argv, fds)
+
+            send_retcode(reply, rc)
+        except ConnectionError:
             pass
 
+    def _run(self, argv, fds):
+        rc, _ = self.cont.run(
+            argv,
+            su=True, net=True, ro_root=False, skip_refresh=True,
+            stdin=fds[0], stdout=fds[1], stderr=fds[2],
+        )
+        return rc
+
+    def finish(self):
+        for worker in self.workers:
+            worker.join()
+
+    def _err(self, fds, reply, fmt, *args):
+        msg = fmt % args
+
+        if len(fds) > 2:
+            try:
+                os.write(fds[2], msg.encode("utf-8") + b"\n")
+            except OSError:
+                pass
+
         try:
-            send_retcode(self.request, 1)
+            send_retcode(reply, 1)
         except ConnectionError:
             pass
 
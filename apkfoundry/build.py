@@ -2,22 +2,32 @@
 # Copyright (c) 2019-2021 Max Rees
 # See LICENSE for more information.
 import argparse   # ArgumentParser, SUPPRESS
+import collections # defaultdict
+import concurrent.futures # FIRST_COMPLETED, ThreadPoolExecutor, wait
 import enum       # Enum, IntFlag, unique
 import functools  # partial
+import heapq      # heapify, heappop, heappush
+import json       # dump, load
 import logging    # getLogger
-import os         # access, *_OK, walk
+import os         # access, *_OK, scandir
 import re         # compile
 import shutil     # chown, copy2, rmtree
-import subprocess # check_output
 import tempfile   # mkdtemp
 import textwrap   # TextWrapper
-import time       # time
+import time       # monotonic
 from pathlib import Path
 
-import apkfoundry           # DEFAULT_ARCH, LOCALSTATEDIR, MOUNTS, proj_conf
-import apkfoundry.container # cont_make
+import apkfoundry           # CONTAINER_POOL, DEFAULT_ARCH, DISTFILES_CACHE,
+                            # DURATIONS_CACHE, LOCALSTATEDIR, MOUNTS,
+                            # SNAPSHOTS, proj_conf
+import apkfoundry.container # Container, cont_make, cont_reuse,
+                            # pool_checkin, pool_checkout, pool_discard,
+                            # pool_key, pool_ready
 import apkfoundry.digraph   # generate_graph
+import apkfoundry._changes as _changes
+import apkfoundry._distfiles as _distfiles
 import apkfoundry._log as _log
+import apkfoundry._results as _results
 import apkfoundry._util as _util
 
 _LOGGER = logging.getLogger(__name__)
@@ -55,6 +65,10 @@ _REPORT_STATUSES = (
 )
 _NET_OPTION = re.compile(r"""^options=(["']?)[^"']*\bnet\b[^"']*\1""")
 _wrap = textwrap.TextWrapper()
+_SLOWEST = 5
+_DURATIONS_VERSION = 1
+# Weight given to the newest build when updating the duration history
+_DURATIONS_WEIGHT = 0.5
 
 def _stats_list(status, l):
     if not l:
@@ -65,7 +79,23 @@ def _stats_list(status, l):
     for i in l:
         _log.msg2(_LOGGER, "%s", i)
 
-def _stats_builds(done):
+def _stats_slowest(stats):
+    if not stats:
+        return
+
+    slowest = sorted(stats.items(), key=lambda i: i[1]["wall"], reverse=True)
+    _LOGGER.info("Slowest:")
+    for startdir, stat in slowest[:_SLOWEST]:
+        if stat["utime"] is None:
+            _log.msg2(_LOGGER, "%s: %.1fs", startdir, stat["wall"])
+            continue
+        _log.msg2(
+            _LOGGER, "%s: %.1fs (%.1fs CPU, %d MiB max RSS)",
+            startdir, stat["wall"], stat["utime"] + stat["stime"],
+            stat["maxrss"] // 1024,
+        )
+
+def _stats_builds(done, stats=None):
     _LOGGER.info("Total: %d", len(done))
 
     statuses = {
@@ -75,13 +105,14 @@ def _stats_builds(done):
 
     for status, startdirs in statuses.items():
         _stats_list(status, startdirs)
+    _stats_slowest(stats)
 
     for status in set(_REPORT_STATUSES) - {Status.SUCCESS}:
         if any(statuses[status]):
             return 1
     return 0
 
-def _run_env(cont, startdir):
+def _run_env(cont, startdir, cleanup_deps=False):
     buildbase = Path(apkfoundry.MOUNTS["builddir"]) / startdir
 
     tmp_real = cont.cdir / "af/config/builddir" / startdir / "tmp"
@@ -101,21 +132,87 @@ def _run_env(cont, startdir):
 
         "ABUILD_TMP": str(apkfoundry.MOUNTS["builddir"]),
         # "deps" is a waste of time since world will be refreshed
-        # on next package
-        "CLEANUP": "srcdir pkgdir",
+        # on next package (unless the refresh is skipped)
+        "CLEANUP": "srcdir pkgdir deps" if cleanup_deps else "srcdir pkgdir",
         "ERROR_CLEANUP": "",
     }
 
     return env, tmp_real
 
-def run_task(cont, conf, startdir, script):
-    env, tmp = _run_env(cont, startdir)
-    repo = startdir.split("/")[0]
+def _snapshot(cont, startdir):
+    """
+    Return the size and modification time of every file in the output
+    directory of the given STARTDIR (REPODEST/REPO/ARCH and its logs
+    subdirectory), keyed by their path relative to REPODEST.
+    """
+    repodest = cont.cdir / "af/config/repodest"
+    outdir = repodest / startdir.split("/")[0] / cont.arch
+    prefix = str(outdir.relative_to(repodest))
+
+    snapshot = {}
+    todo = [(outdir, prefix)]
+    while todo:
+        path, rel = todo.pop()
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            continue
+
+        for entry in entries:
+            name = rel + "/" + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                # The packages themselves are not in subdirectories
+                if path != outdir or entry.name == "logs":
+                    todo.append((entry.path, name))
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            snapshot[name] = (stat.st_size, stat.st_mtime_ns)
+
+    return snapshot
+
+def _package_name(path):
+    """
+    Return the package name of a NAME-PKGVER-rPKGREL.apk or .log file,
+    or None for any other file.
+    """
+    name = path.rsplit("/", maxsplit=1)[-1]
+    for suffix in (".apk", ".log"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)].rsplit("-", maxsplit=2)
+            return name[0] if len(name) == 3 else None
+    return None
+
+def _new_files(before, after, names=None):
+    """
+    Return the files that were added or changed between two snapshots
+    and their sizes. If names is given, the result is split into files
+    belonging to one of the given package names and all others.
+    """
+    changed = {
+        path: stat[0] for path, stat in after.items()
+        if before.get(path) != stat
+    }
+    if names is None:
+        return changed, {}
+
+    owned = {}
+    other = {}
+    for path, size in changed.items():
+        if _package_name(path) in names:
+            owned[path] = size
+        else:
+            other[path] = size
+    return owned, other
+
+def run_task(cont, conf, startdir, script, *, skip_refresh=False,
+        files=None, stats=None, results=None, names=None):
+    env, tmp = _run_env(cont, startdir, cleanup_deps=skip_refresh)
+    repo = None if skip_refresh else startdir.split("/")[0]
 
     APKBUILD = cont.cdir / f"af/config/aportsdir/{startdir}/APKBUILD"
     net = conf.getboolean("build.networking")
     if not net:
-        with open(APKBUILD) as f:
+        with open(APKBUILD, encoding="utf-8") as f:
             for line in f:
                 if _NET_OPTION.search(line) is not None:
                     net = True
@@ -123,14 +220,50 @@ def run_task(cont, conf, startdir, script):
     if net:
         _LOGGER.warning("%s: network access enabled", startdir)
 
-    rc, _ = cont.run(
+    before = _snapshot(cont, startdir)
+    wall = time.monotonic()
+    rc, proc = cont.run(
         [script, startdir],
         repo=repo,
         env=env,
         net=net,
+        skip_refresh=skip_refresh,
         chdir=Path(apkfoundry.MOUNTS["aportsdir"]) / startdir,
     )
 
+    wall = time.monotonic() - wall
+
+    # Only the package's own output directory can have changed, so
+    # there is no need to walk the whole (possibly persistent)
+    # repodest afterwards. Concurrent builds from the same repository
+    # write to the same directory, so in that case only the files named
+    # after this STARTDIR's packages are attributed to it.
+    new_files, other_files = _new_files(
+        before, _snapshot(cont, startdir), names,
+    )
+    if files is not None:
+        files.update(new_files)
+        files.update(other_files)
+    if stats is not None:
+        # Commands run through a container session are not children of
+        # this process, so only their wall time is known
+        rusage = getattr(proc, "rusage", None)
+        stats[startdir] = {
+            "rc": rc,
+            "wall": round(wall, 3),
+            "utime": rusage and round(rusage.ru_utime, 3),
+            "stime": rusage and round(rusage.ru_stime, 3),
+            "maxrss": rusage and rusage.ru_maxrss,
+            "bytes": sum(new_files.values()),
+        }
+    if results is not None:
+        if rc == 0:
+            results.store(
+                startdir, [i for i in new_files if i.endswith(".apk")],
+            )
+        else:
+            results.discard(startdir)
+
     if rc == 0:
         try:
             # Only remove TEMP files, not src/pkg
@@ -189,6 +322,365 @@ def _interrupt(cont, startdir):
 
     return None
 
+def _durations_file(arch):
+    return apkfoundry.DURATIONS_CACHE / f"{arch}.json"
+
+def _load_durations(arch):
+    try:
+        with open(_durations_file(arch), encoding="utf-8") as f:
+            durations = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if durations.get("version") != _DURATIONS_VERSION:
+        return {}
+    return durations.get("startdirs", {})
+
+def _save_durations(arch, stats):
+    durations = _load_durations(arch)
+    for startdir, stat in stats.items():
+        # Failed builds usually stop early and would skew the history
+        if stat["rc"] != 0:
+            continue
+        old = durations.get(startdir, stat["wall"])
+        durations[startdir] = round(
+            old + _DURATIONS_WEIGHT * (stat["wall"] - old), 3,
+        )
+
+    durations_file = _durations_file(arch)
+    durations_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = durations_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(
+            {"version": _DURATIONS_VERSION, "startdirs": durations},
+            f, separators=(",", ":"),
+        )
+    os.replace(tmp, durations_file)
+
+def _fmt_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02}m"
+    if minutes:
+        return f"{minutes}m{seconds:02}s"
+    return f"{seconds}s"
+
+class _BuildQueue:
+    """
+    Track which of the requested STARTDIRs are ready to be built, i.e.
+    which ones have no unbuilt dependencies left among the requested
+    STARTDIRs. Dependencies on STARTDIRs that were not requested are
+    followed transitively so that the ordering of the full graph is
+    preserved.
+
+    When several STARTDIRs are ready, the one heading the longest chain
+    of remaining builds is chosen first, weighted by the durations of
+    previous builds if they are known.
+    """
+
+    __slots__ = (
+        "rdeps",
+        "deps",
+        "ndeps",
+        "ready",
+        "durations",
+        "priority",
+    )
+
+    def __init__(self, graph, startdirs, durations=None):
+        self.rdeps = {i: set() for i in startdirs}
+        self.ndeps = dict.fromkeys(startdirs, 0)
+
+        for dep in self.rdeps:
+            seen = set()
+            todo = graph.downstream(dep)
+            while todo:
+                rdep = todo.pop()
+                if rdep in seen:
+                    continue
+                seen.add(rdep)
+                if rdep in self.rdeps:
+                    self.rdeps[dep].add(rdep)
+                else:
+                    todo.extend(graph.downstream(rdep))
+
+        # Forward edges, so that removing a STARTDIR only touches its
+        # neighbours
+        self.deps = {i: set() for i in startdirs}
+        for dep, rdeps in self.rdeps.items():
+            for rdep in rdeps:
+                self.deps[rdep].add(dep)
+                self.ndeps[rdep] += 1
+
+        self.ready = {i for i, n in self.ndeps.items() if not n}
+
+        # STARTDIRs without any history are assumed to take an average
+        # amount of time
+        durations = durations or {}
+        known = [durations[i] for i in self.ndeps if i in durations]
+        default = sum(known) / len(known) if known else 1.0
+        self.durations = {i: durations.get(i, default) for i in self.ndeps}
+
+        self.priority = {}
+        for startdir in reversed(self._tsort()):
+            self.priority[startdir] = self.durations[startdir] + max(
+                (self.priority[i] for i in self.rdeps[startdir]), default=0,
+            )
+
+    def _tsort(self):
+        ndeps = self.ndeps.copy()
+        todo = list(self.ready)
+        order = []
+        while todo:
+            startdir = todo.pop()
+            order.append(startdir)
+            for rdep in self.rdeps.get(startdir, ()):
+                ndeps[rdep] -= 1
+                if not ndeps[rdep]:
+                    todo.append(rdep)
+        return order
+
+    def _key(self, startdir):
+        return (-self.priority[startdir], startdir)
+
+    def __len__(self):
+        return len(self.ndeps)
+
+    def pop(self, repo=None):
+        """
+        Return the next STARTDIR that is ready to be built, or None if
+        there are none. If repo is given, only consider STARTDIRs from
+        that repository.
+        """
+        if repo:
+            ready = [i for i in self.ready if i.startswith(repo + "/")]
+        else:
+            ready = self.ready
+        if not ready:
+            return None
+
+        startdir = min(ready, key=self._key)
+        self.ready.remove(startdir)
+        return startdir
+
+    def finish(self, startdir):
+        """
+        Mark the given STARTDIR as built and release its reverse
+        dependencies.
+        """
+        for rdep in self.rdeps.pop(startdir, ()):
+            if rdep not in self.ndeps:
+                continue
+            self.deps[rdep].discard(startdir)
+            self.ndeps[rdep] -= 1
+            if not self.ndeps[rdep]:
+                self.ready.add(rdep)
+        self.deps.pop(startdir, None)
+        self.ndeps.pop(startdir, None)
+        self.ready.discard(startdir)
+
+    def remove(self, startdirs):
+        """
+        Remove the given STARTDIRs from consideration without releasing
+        their reverse dependencies.
+        """
+        for startdir in startdirs:
+            # Their dependencies may still list them as reverse
+            # dependencies (e.g. the other side of a diamond)
+            for dep in self.deps.pop(startdir, ()):
+                if dep in self.rdeps:
+                    self.rdeps[dep].discard(startdir)
+            for rdep in self.rdeps.pop(startdir, ()):
+                if rdep in self.deps:
+                    self.deps[rdep].discard(startdir)
+            self.ndeps.pop(startdir, None)
+            self.ready.discard(startdir)
+
+    def order(self):
+        """
+        Return the order in which the remaining STARTDIRs would be built
+        if they were built one at a time.
+        """
+        ndeps = self.ndeps.copy()
+        ready = [self._key(i) for i in self.ready]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, startdir = heapq.heappop(ready)
+            order.append(startdir)
+            for rdep in self.rdeps.get(startdir, ()):
+                ndeps[rdep] -= 1
+                if not ndeps[rdep]:
+                    heapq.heappush(ready, self._key(rdep))
+        return order
+
+    def eta(self, jobs=1):
+        """
+        Estimate how long the remaining STARTDIRs will take to build.
+        No build can finish before the longest remaining chain, nor
+        before the total work is shared among the jobs.
+        """
+        if not self.ndeps:
+            return 0
+        critical = max(self.priority[i] for i in self.ndeps)
+        total = sum(self.durations[i] for i in self.ndeps)
+        return max(critical, total / jobs)
+
+def _log_order(queue, done, tot, jobs=1, durations=None):
+    _log.section_start(_LOGGER, "build_order", "Build order:\n")
+    for cur, startdir in enumerate(queue.order(), start=len(done) + 1):
+        _log.msg2(_LOGGER, "(%d/%d) %s", cur, tot, startdir)
+    if durations:
+        unknown = sum(1 for i in queue.ndeps if i not in durations)
+        _LOGGER.info(
+            "Estimated time to completion: %s%s",
+            _fmt_duration(queue.eta(jobs)),
+            f" ({unknown} without build history)" if unknown else "",
+        )
+    _log.section_end(_LOGGER)
+
+def _on_failure(cont, graph, startdir, initial, done, opts, on_failure):
+    if opts.interactive:
+        action = _interrupt(cont, startdir)
+        while action is None:
+            action = _interrupt(cont, startdir)
+    else:
+        action = on_failure
+
+    if action == FailureAction.RECALCULATE:
+        _log.section_start(
+            _LOGGER, "recalc-order", "Recalculating build order"
+        )
+
+        depfails = set(graph.all_downstreams(startdir))
+        for rdep in depfails:
+            graph.delete_node(rdep)
+        graph.delete_node(startdir)
+
+        for rdep in depfails & initial:
+            _LOGGER.error("Depfail: %s", rdep)
+            done[rdep] = Status.DEPFAIL
+
+        _log.section_end(_LOGGER)
+        return action, depfails
+
+    if action == FailureAction.STOP:
+        _LOGGER.error("Stopping due to previous error")
+    elif action == FailureAction.IGNORE:
+        _LOGGER.info("Ignoring error and continuing")
+
+    return action, set()
+
+def _cached(opts, startdir, cur, tot):
+    if not opts.results or not opts.results.lookup(startdir):
+        return False
+
+    _LOGGER.info("(%d/%d) Cached: %s", cur, tot, startdir)
+    return True
+
+def _run_task_parallel(cont, conf, startdir, script, files, stats, results,
+        names):
+    # Each concurrent build gets its own af-sudo connection, since
+    # requests are answered in order over a single connection
+    task_cont = apkfoundry.container.Container(cont.cdir)
+    try:
+        return run_task(
+            task_cont, conf, startdir, script,
+            skip_refresh=True, files=files, stats=stats, results=results,
+            names=names,
+        )
+    finally:
+        task_cont.sudo_conn.close()
+
+def _run_graph_parallel(cont, conf, graph, opts, initial, on_failure,
+        durations):
+    done = {}
+    queue = _BuildQueue(graph, initial, durations)
+    tot = len(queue)
+    _log_order(queue, done, tot, opts.jobs, durations)
+
+    # Package names built by each STARTDIR, used to tell apart the
+    # output of concurrent builds
+    names = collections.defaultdict(set)
+    for name, startdir in graph.origins.items():
+        names[startdir].add(name)
+
+    # The refresh script resets the world file, so it can only be run
+    # when no builds are in progress. Builds from the same repository
+    # share the most recent refresh.
+    refreshed = None
+    running = {}
+    stop = False
+
+    def finish(startdir, cur, rc):
+        nonlocal stop
+
+        if rc == 0:
+            _LOGGER.info("(%d/%d) Success: %s", cur, tot, startdir)
+            done[startdir] = Status.SUCCESS
+            queue.finish(startdir)
+            return
+
+        _LOGGER.error("(%d/%d) Fail: %s", cur, tot, startdir)
+        done[startdir] = Status.FAIL
+
+        action, depfails = _on_failure(
+            cont, graph, startdir, initial, done, opts, on_failure,
+        )
+        if action == FailureAction.RECALCULATE:
+            queue.remove(depfails | {startdir})
+        elif action == FailureAction.STOP:
+            stop = True
+        elif action == FailureAction.IGNORE:
+            queue.finish(startdir)
+
+    with concurrent.futures.ThreadPoolExecutor(opts.jobs) as pool:
+        while True:
+            while not stop and len(running) < opts.jobs:
+                startdir = queue.pop(refreshed)
+                if startdir is None and not running:
+                    startdir = queue.pop()
+                if startdir is None:
+                    break
+
+                cur = len(done) + len(running) + 1
+                if _cached(opts, startdir, cur, tot):
+                    done[startdir] = Status.SUCCESS
+                    queue.finish(startdir)
+                    continue
+
+                repo = startdir.split("/")[0]
+                if repo != refreshed:
+                    cont.repo = repo
+                    if cont.refresh():
+                        refreshed = None
+                        finish(startdir, cur, 1)
+                        continue
+                    refreshed = repo
+
+                _LOGGER.info("(%d/%d) Start: %s", cur, tot, startdir)
+                future = pool.submit(
+                    _run_task_parallel, cont, conf, startdir, opts.build_script,
+                    opts.filelist, opts.stats, opts.results,
+                    names.get(startdir),
+                )
+                running[future] = (startdir, cur)
+
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in finished:
+                finish(*running.pop(future), future.result())
+
+    for rdep in initial - set(done.keys()):
+        done[rdep] = Status.DEPFAIL
+
+    return _stats_builds(done, opts.stats)
+
 def run_graph(cont, conf, graph, opts):
     initial = set(opts.startdirs)
     done = {}
@@ -207,95 +699,106 @@ def run_graph(cont, conf, graph, opts):
             _LOGGER.error("%s/APKBUILD does not exist!", i)
             return 1
 
+    durations = _load_durations(cont.arch)
+    if opts.jobs > 1:
+        return _run_graph_parallel(
+            cont, conf, graph, opts, initial, on_failure, durations,
+        )
+
+    queue = _BuildQueue(graph, initial, durations)
+    tot = len(queue)
+    _log_order(queue, done, tot, durations=durations)
+
     while True:
-        order = [
-            i for i in graph.topological_sort()
-            if i in initial and i not in done
-        ]
-        if not order:
+        startdir = queue.pop()
+        if startdir is None:
             break
 
-        tot = len(order) + len(done.keys())
-        cur = len(done.keys())
+        cur = len(done) + 1
+        if _cached(opts, startdir, cur, tot):
+            done[startdir] = Status.SUCCESS
+            queue.finish(startdir)
+            continue
+
+        _log.section_start(
+            _LOGGER, "build_" + startdir.replace("/", "_"),
+            "(%d/%d) Start: %s", cur, tot, startdir
+        )
 
-        _log.section_start(_LOGGER, "build_order", "Build order:\n")
-        for startdir in order:
-            cur += 1
-            _log.msg2(_LOGGER, "(%d/%d) %s", cur, tot, startdir)
-        _log.section_end(_LOGGER)
+        rc = run_task(
+            cont, conf, startdir, opts.build_script,
+            files=opts.filelist, stats=opts.stats, results=opts.results,
+        )
 
-        cur = len(done.keys())
-        for startdir in order:
-            cur += 1
-            _log.section_start(
-                _LOGGER, "build_" + startdir.replace("/", "_"),
-                "(%d/%d) Start: %s", cur, tot, startdir
+        if rc == 0:
+            _log.section_end(
+                _LOGGER, "(%d/%d) Success: %s", cur, tot, startdir,
             )
+            done[startdir] = Status.SUCCESS
+            queue.finish(startdir)
+            continue
 
-            rc = run_task(cont, conf, startdir, opts.build_script)
+        _log.section_end(
+            _LOGGER, "(%d/%d) Fail: %s", cur, tot, startdir,
+        )
+        done[startdir] = Status.FAIL
 
-            if rc == 0:
-                _log.section_end(
-                    _LOGGER, "(%d/%d) Success: %s", cur, tot, startdir,
-                )
-                done[startdir] = Status.SUCCESS
+        action, depfails = _on_failure(
+            cont, graph, startdir, initial, done, opts, on_failure,
+        )
 
-            else:
-                _log.section_end(
-                    _LOGGER, "(%d/%d) Fail: %s", cur, tot, startdir,
-                )
-                done[startdir] = Status.FAIL
+        if action == FailureAction.RECALCULATE:
+            # Only the failed build and its reverse dependencies need to
+            # be dropped; the rest of the plan is still valid.
+            queue.remove(depfails | {startdir})
+            _log_order(queue, done, tot, durations=durations)
 
-                if opts.interactive:
-                    action = _interrupt(cont, startdir)
-                    while action is None:
-                        action = _interrupt(cont, startdir)
-                else:
-                    action = on_failure
-
-                if action == FailureAction.RECALCULATE:
-                    _log.section_start(
-                        _LOGGER, "recalc-order", "Recalculating build order"
-                    )
-
-                    depfails = set(graph.all_downstreams(startdir))
-                    for rdep in depfails:
-                        graph.delete_node(rdep)
-                    graph.delete_node(startdir)
-
-                    depfails &= initial
-                    for rdep in depfails:
-                        _LOGGER.error("Depfail: %s", rdep)
-                        done[rdep] = Status.DEPFAIL
-
-                    _log.section_end(_LOGGER)
-
-                elif action == FailureAction.STOP:
-                    _LOGGER.error("Stopping due to previous error")
-                    cancels = initial - set(done.keys())
-                    for rdep in cancels:
-                        done[rdep] = Status.DEPFAIL
-                    graph.reset_graph()
-
-                elif action == FailureAction.IGNORE:
-                    _LOGGER.info("Ignoring error and continuing")
-                    continue
+        elif action == FailureAction.STOP:
+            cancels = initial - set(done.keys())
+            for rdep in cancels:
+                done[rdep] = Status.DEPFAIL
+            break
 
-                break
+        elif action == FailureAction.IGNORE:
+            queue.finish(startdir)
 
-    return _stats_builds(done)
+    return _stats_builds(done, opts.stats)
 
-def run_job(cont, conf, opts):
+def _job_graph(cont, conf, opts):
     _log.section_start(
         _LOGGER, "gen-build-order", "Generating build order...",
     )
     graph = apkfoundry.digraph.generate_graph(conf, cont=cont)
     if not graph or not graph.is_acyclic():
         _LOGGER.error("failed to generate dependency graph")
-        return 1
+        return None
     _log.section_end(_LOGGER)
 
-    return run_graph(cont, conf, graph, opts)
+    if opts.with_rdeps is not None:
+        _rdeps_list(conf, opts, graph)
+
+    return graph
+
+def run_job(cont, conf, opts):
+    graph = _job_graph(cont, conf, opts)
+    if not graph:
+        return 1
+
+    opts.results = None
+    if conf.getboolean("build.result-cache"):
+        opts.results = _results.ResultCache(cont, graph, opts.build_script)
+
+    if opts.prefetch:
+        _log.section_start(
+            _LOGGER, "prefetch", "Prefetching sources...",
+        )
+        _distfiles.prefetch(cont, opts.startdirs)
+        _log.section_end(_LOGGER)
+
+    rc = run_graph(cont, conf, graph, opts)
+    if opts.results:
+        opts.results.save()
+    return rc
 
 def run_after(rc, cont, conf, afterdir, script):
     if not script:
@@ -319,39 +822,28 @@ def run_after(rc, cont, conf, afterdir, script):
             "AF_RC": str(rc),
             "AF_AFTERDIR": "/af/config/afterdir" if afterdir else "",
             "AF_FILELIST": "/af/config/filelist",
+            "AF_STATS": "/af/config/stats.json",
         },
     )
     _log.section_end(_LOGGER)
     return rc
 
 def changed_pkgs(conf, opts):
-    gitdir = ["-C", str(opts.aportsdir)] \
-        if opts.aportsdir else []
-    pickaxe = ["-G", "^pkg(ver|rel)="] \
-        if conf.getboolean("build.only-changed-versions") else []
-
-    pkgs = subprocess.check_output(
-        ("git", *gitdir, "diff-tree",
-         "-r", "--name-only", "--diff-filter", "dxu", *pickaxe,
-         *opts.rev_range.split(), "--", "*/*/APKBUILD"),
-        encoding="utf-8"
-    ).splitlines()
-    return [i.replace("/APKBUILD", "") for i in pkgs]
-
-def _save_filelist(cont, start):
-    files = []
-    repodest = cont.cdir / "af/config/repodest"
-    for dpath, _, fnames in os.walk(repodest):
-        dpath = Path(dpath)
-        for fname in fnames:
-            fname = dpath / fname
-            if fname.stat().st_mtime > start:
-                files.append(str(fname.relative_to(repodest)))
+    return _changes.changed_startdirs(
+        opts.aportsdir, opts.rev_range,
+        conf.getboolean("build.only-changed-versions"),
+    )
 
+def _save_filelist(cont, files):
     files = "\n".join(sorted(files)) + "\n"
     filelist = cont.cdir / "af/config/filelist"
     filelist.write_text(files)
 
+def _save_stats(cont, stats):
+    with open(cont.cdir / "af/config/stats.json", "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=1)
+        f.write("\n")
+
 def _cleanup(rc, cont, delete):
     if hasattr(cont, "destroy"):
         destroy = cont.destroy
@@ -398,6 +890,22 @@ def _build_list(conf, opts):
         _log.section_end(_LOGGER)
         opts.startdirs.extend(_filter_list(conf, opts, pkgs))
 
+def _rdeps_list(conf, opts, graph):
+    _log.section_start(
+        _LOGGER, "rdeps_pkgs",
+        "Determining reverse dependencies...",
+    )
+    depth = opts.with_rdeps or None
+    rdeps = set()
+    for startdir in opts.startdirs:
+        if startdir in graph.graph:
+            rdeps.update(graph.all_downstreams(startdir, depth))
+    rdeps = sorted(rdeps - set(opts.startdirs))
+    _log.msg2(_LOGGER, rdeps)
+    _log.section_end(_LOGGER)
+
+    opts.startdirs.extend(list(_filter_list(conf, opts, rdeps)))
+
 def _filter_list(conf, opts, startdirs):
     _log.section_start(
         _LOGGER, "skip_pkgs",
@@ -463,12 +971,24 @@ def _buildrepo_args(args):
         help=f"""use CDIR as the container root (default: temporary
         directory in {apkfoundry.LOCALSTATEDIR})""",
     )
+    cont.add_argument(
+        "--pool", action="store_true",
+        help=f"""reuse a bootstrapped container from the pool in
+        {apkfoundry.CONTAINER_POOL} instead of making a new one
+        (implies --delete never)""",
+    )
     cont.add_argument(
         "--setarch",
         help="""setarch(8) architecture name (default: look in site
         configuration, otherwise none)""",
     )
     cont.add_argument("-S", help=argparse.SUPPRESS)
+    cont.add_argument(
+        "--snapshot", action="store_true",
+        help=f"""use a shared, read-only bootstrapped rootfs from
+        {apkfoundry.SNAPSHOTS} with a private writable overlay instead
+        of extracting a new rootfs (default: off)""",
+    )
 
     checkout = opts.add_argument_group(
         title="Checkout options",
@@ -505,16 +1025,39 @@ def _buildrepo_args(args):
     )
     opts.add_argument(
         "--dry-run", action="store_true",
-        help="only show what would be built, then exit",
+        help="""only show what would be built, then exit. With
+        --with-rdeps, a container is still bootstrapped to determine the
+        reverse dependencies""",
     )
     opts.add_argument(
         "-i", "--interactive", action="store_true",
         help="interactively stop when a package fails to build",
     )
+    opts.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=1,
+        help="""build up to N independent packages at the same time
+        (default: 1). The builds share one container, so a
+        build-script that changes its root filesystem (e.g. with
+        $SUDO_APK upgrade) affects all concurrent builds""",
+    )
+    opts.add_argument(
+        "--prefetch", action="store_true",
+        help=f"""download the sources of all packages to be built
+        concurrently before building, using a shared cache in
+        {apkfoundry.DISTFILES_CACHE}""",
+    )
     opts.add_argument(
         "-r", "--rev-range",
         help="git revision range for changed APKBUILDs",
     )
+    opts.add_argument(
+        "--with-rdeps", metavar="DEPTH", nargs="?", type=int, const=0,
+        help="""also build the reverse dependencies of the packages to be
+        built, up to DEPTH levels away (default: all of them). DEPTH
+        must be given as --with-rdeps=DEPTH. Skipped packages and
+        repositories not enabled for the architecture are honored as
+        usual""",
+    )
     opts.add_argument(
         "--build-script",
         help="""Alternative build-script to use instead of
@@ -553,6 +1096,15 @@ def _buildrepo_args(args):
     if opts.script:
         _LOGGER.warning("--script is deprecated. Use --build-script.")
         opts.build_script = opts.script
+    if opts.jobs < 1:
+        _LOGGER.warning("--jobs must be at least 1.")
+        opts.jobs = 1
+    if opts.interactive and opts.jobs > 1:
+        _LOGGER.warning("--interactive implies --jobs 1.")
+        opts.jobs = 1
+    if opts.pool and opts.directory:
+        _LOGGER.warning("--directory overrides --pool.")
+        opts.pool = False
 
     return opts
 
@@ -578,13 +1130,38 @@ def _buildrepo_bootstrap(opts, cdir):
             return None
     if opts.setarch:
         cont_make_args += ["--setarch", opts.setarch]
+    if opts.snapshot:
+        cont_make_args.append("--snapshot")
 
     cont_make_args += [
         "--arch", opts.arch,
         "--branch", opts.branch,
         "--", str(cdir), str(opts.aportsdir),
     ]
-    cont = apkfoundry.container.cont_make(cont_make_args)
+    key = None
+    if opts.pool:
+        key = apkfoundry.container.pool_key(
+            opts.aportsdir, opts.branch, opts.arch,
+        )
+    if opts.pool and apkfoundry.container.pool_ready(cdir, key):
+        _LOGGER.info("Resetting pooled container...")
+        # A container whose reset failed or was interrupted is not
+        # reused; it is destroyed and bootstrapped again next time
+        apkfoundry.container.pool_discard(cdir)
+        cont = apkfoundry.container.cont_reuse(cont_make_args)
+        if cont:
+            apkfoundry.container.pool_checkin(cdir, key)
+    else:
+        if opts.pool and cdir.exists():
+            # Left behind by an interrupted bootstrap or a failed reset,
+            # or bootstrapped from a different rootfs or bootstrap script
+            _LOGGER.info("Destroying stale pooled container...")
+            rc = apkfoundry.container.Container(cdir, sudo=False).destroy()
+            if rc:
+                return None
+        cont = apkfoundry.container.cont_make(cont_make_args)
+        if cont and opts.pool:
+            apkfoundry.container.pool_checkin(cdir, key)
 
     _log.section_end(_LOGGER)
     return cont
@@ -610,8 +1187,19 @@ def buildrepo(args):
         if not opts.branch:
             opts.branch = _util.get_branch(opts.aportsdir)
 
+    if opts.pool and opts.git_url:
+        _LOGGER.error("--pool requires -a APORTSDIR")
+        return _cleanup(1, None, opts.delete)
+
+    pool_lock = None
     if opts.directory:
         cdir = Path(opts.directory)
+    elif opts.pool:
+        # Pooled containers are kept until the next job resets them
+        opts.delete = "never"
+        cdir, pool_lock = apkfoundry.container.pool_checkout(
+            opts.aportsdir, opts.branch, opts.arch,
+        )
     else:
         apkfoundry.LOCALSTATEDIR.mkdir(parents=True, exist_ok=True)
         cdir = Path(tempfile.mkdtemp(dir=apkfoundry.LOCALSTATEDIR, suffix=".af"))
@@ -654,7 +1242,9 @@ def buildrepo(args):
         _LOGGER.info("No packages to build!")
         return _cleanup(0, cdir, opts.delete)
 
-    if opts.dry_run:
+    # Reverse dependencies are found using the dependency graph, which
+    # needs a container
+    if opts.dry_run and opts.with_rdeps is None:
         return _cleanup(0, cdir, opts.delete)
 
     cont = _buildrepo_bootstrap(opts, cdir)
@@ -662,9 +1252,22 @@ def buildrepo(args):
         _LOGGER.error("Failed to bootstrap container")
         return _cleanup(1, cont, opts.delete)
 
-    start = time.time()
+    if opts.dry_run:
+        rc = 0 if _job_graph(cont, conf, opts) else 1
+        rc = _cleanup(rc, cont, opts.delete)
+        if pool_lock:
+            pool_lock.close()
+        return rc
+
+    opts.filelist = {}
+    opts.stats = {}
     rc = run_job(cont, conf, opts)
-    _save_filelist(cont, start)
+    _save_filelist(cont, opts.filelist)
+    _save_stats(cont, opts.stats)
+    _save_durations(cont.arch, opts.stats)
     rc = run_after(rc, cont, conf, opts.afterdir, opts.after_script) or rc
 
-    return _cleanup(rc, cont, opts.delete)
+    rc = _cleanup(rc, cont, opts.delete)
+    if pool_lock:
+        pool_lock.close()
+    return rc
@@ -2,19 +2,33 @@
 # Copyright (c) 2019-2021 Max Rees
 # See LICENSE for more information.
 import argparse   # ArgumentParser, SUPPRESS
+import atexit     # register
+import collections # defaultdict
+import fcntl      # flock, LOCK_EX, LOCK_NB
+import hashlib    # sha256
+import io         # TextIOBase
 import json       # load
 import logging    # getLogger
 import os         # close, environ, fdopen, getgid, getuid, listdir, pipe, write
-                  # isatty, tcgetpgrp, tcsetpgrp
+                  # isatty, tcgetpgrp, tcsetpgrp, cpu_count, devnull, dup2,
+                  # fork, fsencode, open, O_RDWR, read, rename, setsid, wait4,
+                  # WEXITSTATUS, WIFSIGNALED, WTERMSIG, _exit
 import select     # select
+import selectors  # DefaultSelector, EVENT_READ
 import shutil     # chown, copy2, copytree, rmtree
 import signal     # SIG_IGN, signal, SIGTTOU
-import subprocess # call, Popen
+import socket     # AF_UNIX, SCM_RIGHTS, SOCK_SEQPACKET, SOL_SOCKET,
+                  # socketpair
+import struct     # calcsize, pack, unpack
+import subprocess # call, DEVNULL, Popen
 import sys        # stdin
+import tempfile   # TemporaryFile
+import threading  # Lock
 from pathlib import Path
 
-import apkfoundry         # BWRAP, DEFAULT_ARCH, HOME, LIBEXECDIR, MOUNTS,
-                          # ROOTFS_CACHE, SYSCONFDIR, proj_conf, site_conf
+import apkfoundry         # BWRAP, CONTAINER_POOL, DEFAULT_ARCH, HOME,
+                          # LIBEXECDIR, MOUNTS, ROOTFS_CACHE, SNAPSHOTS,
+                          # SYSCONFDIR, proj_conf, site_conf
 import apkfoundry._rootfs as _rootfs
 import apkfoundry._sudo as _sudo
 import apkfoundry._util as _util
@@ -30,6 +44,26 @@ _SUBIDS = {
     "newgidmap": _SITE_CONF.getint("container", "subgid"),
 }
 _ABUILD_USERDIR = "af/config/abuild"
+_POOL_MARKER = "af/pool"
+_SNAPSHOT_MARKER = "af/snapshot"
+_OVERLAY_BASE = "af/base"
+_OVERLAY_UPPER = "af/overlay/upper"
+_OVERLAY_WORK = "af/overlay/work"
+_REFRESH_STATE = "af/refresh"
+_DESTROY_DEPTH = 4
+_DESTROY_MAX = 1 << 16
+_CHUNK = 1 << 16
+_REFRESH_OUTPUTS = (
+    "etc/apk/repositories",
+    "etc/apk/world",
+    "etc/abuild.conf",
+)
+
+# Container.run keyword arguments that can be sent to a session
+_SESSION_KWARGS = {"env", "pass_fds", "stdin", "stdout", "stderr", "su"}
+_SESSION_FMT = "i"
+_SESSIONS = collections.defaultdict(list)
+_SESSIONS_LOCK = threading.Lock()
 
 def _idmap(cmd, pid, ent_id):
     holes = {
@@ -66,6 +100,96 @@ def _userns_init(pid, uid, gid):
     retcodes.append(_idmap("newgidmap", pid, gid))
     return retcodes
 
+def _communicate(proc):
+    """Like proc.communicate(), but reap the child with wait4 and keep
+    its resource usage in proc.rusage. Since the child is bwrap, this
+    includes everything run inside the container."""
+    output = {}
+    with selectors.DefaultSelector() as sel:
+        for f in (proc.stdout, proc.stderr):
+            if f:
+                sel.register(f, selectors.EVENT_READ)
+                output[f] = []
+        while sel.get_map():
+            for key, _ in sel.select():
+                data = os.read(key.fd, _CHUNK)
+                if data:
+                    output[key.fileobj].append(data)
+                else:
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+
+    for f, data in output.items():
+        data = b"".join(data)
+        if isinstance(f, io.TextIOBase):
+            data = data.decode(f.encoding)
+        output[f] = data
+
+    _, status, proc.rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    return output.get(proc.stdout), output.get(proc.stderr)
+
+class _Session:
+    __slots__ = (
+        "sock",
+        "proc",
+    )
+
+    def __init__(self, sock, proc):
+        self.sock = sock
+        self.proc = proc
+
+    def call(self, cwd, env, argv, fds):
+        header = struct.pack(
+            f"{2 + len(fds)}{_SESSION_FMT}", 1, len(fds), *fds.keys(),
+        )
+        strings = [cwd, *(f"{k}={v}" for k, v in env.items()), "", *argv]
+        strings = b"".join(str(i).encode("utf-8") + b"\0" for i in strings)
+        fds = struct.pack(f"{len(fds)}{_SESSION_FMT}", *fds.values())
+
+        self.sock.sendmsg(
+            [header + strings],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)],
+        )
+        rc = self.sock.recv(struct.calcsize(_SESSION_FMT))
+        if not rc:
+            raise ConnectionError("session exited unexpectedly")
+
+        return struct.unpack(_SESSION_FMT, rc)[0]
+
+    def close(self):
+        self.sock.close()
+        self.proc.wait()
+
+def _session_get(key):
+    with _SESSIONS_LOCK:
+        idle = _SESSIONS[key]
+        while idle:
+            session = idle.pop()
+            if session.proc.poll() is None:
+                return session
+            session.close()
+
+    return None
+
+def _session_put(key, session):
+    with _SESSIONS_LOCK:
+        _SESSIONS[key].append(session)
+
+def close_sessions(cdir=None):
+    with _SESSIONS_LOCK:
+        keys = [i for i in _SESSIONS if cdir is None or i[0] == str(cdir)]
+        sessions = [j for i in keys for j in _SESSIONS.pop(i)]
+
+    for session in sessions:
+        session.close()
+
+atexit.register(close_sessions)
+
 class Container:
     __slots__ = (
         "cdir",
@@ -78,6 +202,9 @@ class Container:
 
         "_uid",
         "_gid",
+
+        "_mounts",
+        "_setarch",
     )
 
     def __init__(self, cdir, *, sudo=True):
@@ -95,6 +222,9 @@ class Container:
         self._uid = os.getuid()
         self._gid = os.getgid()
 
+        self._mounts = None
+        self._setarch = None
+
     def _read_info(self, name):
         f = self.cdir / name
         if f.is_file():
@@ -129,10 +259,18 @@ class Container:
     @property
     def arch(self):
         if not self._arch:
-            self._arch = self._read_info("etc/apk/arch")
+            arch = self._root_file("etc/apk/arch")
+            if arch.is_file():
+                self._arch = arch.read_text().strip()
         return self._arch
 
-    def _bwrap(self, args, *, net=False, su=False, setsid=True, **kwargs):
+    @property
+    def setarch(self):
+        if self._setarch is None:
+            self._setarch = self._read_info("af/config/setarch") or ""
+        return self._setarch
+
+    def _bwrap_env(self, kwargs, su):
         if "env" not in kwargs:
             kwargs["env"] = {}
         kwargs["env"].update({
@@ -147,15 +285,21 @@ class Container:
             "PATH": "/usr/bin:/usr/sbin:/bin:/sbin",
         })
 
+    def _bwrap_spawn(self, args, *, net, su, setsid, session=False, **kwargs):
+        self._bwrap_env(kwargs, su)
+
         info_r, info_w = os.pipe()
         pipe_r, pipe_w = os.pipe()
         if "pass_fds" not in kwargs:
             kwargs["pass_fds"] = []
         kwargs["pass_fds"].extend((pipe_r, info_w))
 
-        args_pre = [
-            apkfoundry.BWRAP,
-            "--die-with-parent",
+        args_pre = [apkfoundry.BWRAP]
+        # Sessions outlive the thread that spawned them. They exit when
+        # their control socket is closed instead.
+        if not session:
+            args_pre.append("--die-with-parent")
+        args_pre += [
             "--unshare-all",
             "--unshare-user",
             "--userns-block-fd", str(pipe_r),
@@ -167,14 +311,8 @@ class Container:
         if net:
             args_pre.append("--share-net")
 
-        stdin = sys.stdin.fileno()
         if setsid:
             args_pre.append("--new-session")
-            pgrp = None
-        elif os.isatty(stdin):
-            pgrp = os.tcgetpgrp(stdin)
-        else:
-            pgrp = None
 
         if su:
             args_pre.extend([
@@ -204,7 +342,20 @@ class Container:
         os.write(pipe_w, b"\n")
         os.close(pipe_w)
 
-        proc.stdout, proc.stderr = proc.communicate()
+        return retcodes, proc
+
+    def _bwrap(self, args, *, net=False, su=False, setsid=True, **kwargs):
+        stdin = sys.stdin.fileno()
+        if not setsid and os.isatty(stdin):
+            pgrp = os.tcgetpgrp(stdin)
+        else:
+            pgrp = None
+
+        retcodes, proc = self._bwrap_spawn(
+            args, net=net, su=su, setsid=setsid, **kwargs,
+        )
+
+        proc.stdout, proc.stderr = _communicate(proc)
 
         if pgrp:
             handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
@@ -217,13 +368,90 @@ class Container:
             _LOGGER.debug("container failed with status %r!", retcodes)
         return (max(abs(i) for i in retcodes), proc)
 
+    def _use_session(self, setsid, kwargs):
+        if not _SITE_CONF.getboolean("container", "sessions"):
+            return False
+        # Interactive commands need the terminal as their controlling
+        # TTY and so are always run in their own bwrap
+        if not setsid:
+            return False
+        # The lower layers of an overlay must not change while it is
+        # mounted, so sessions cannot be kept open over them
+        if (self.cdir / _OVERLAY_BASE).is_symlink():
+            return False
+        if set(kwargs) - _SESSION_KWARGS:
+            return False
+        for name in ("stdin", "stdout", "stderr"):
+            fd = kwargs.get(name)
+            if not (fd is None or (isinstance(fd, int) and fd >= 0)):
+                return False
+        return True
+
+    def _session_spawn(self, args, *, net, su, env):
+        server, client = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            retcodes, proc = self._bwrap_spawn(
+                args + ["/af/libexec/af-session", str(client.fileno())],
+                net=net, su=su, setsid=True, session=True,
+                env=env, pass_fds=[client.fileno()],
+                stdin=subprocess.DEVNULL,
+            )
+        finally:
+            client.close()
+
+        session = _Session(server, proc)
+        if any(retcodes):
+            _LOGGER.debug("session failed with status %r!", retcodes)
+            session.close()
+            return None
+
+        _LOGGER.debug("Started container session %d", proc.pid)
+        return session
+
+    def _session_run(self, args, cmd, *, net, cwd, su=False, **kwargs):
+        self._bwrap_env(kwargs, su)
+        key = (
+            str(self.cdir), net, su,
+            tuple(str(i) for i in args),
+        )
+
+        session = _session_get(key)
+        if not session:
+            session = self._session_spawn(
+                args, net=net, su=su, env=dict(kwargs["env"]),
+            )
+        if not session:
+            return 1, None
+
+        fds = {}
+        for target, name in enumerate(("stdin", "stdout", "stderr")):
+            fd = kwargs.get(name)
+            fds[target] = target if fd is None else fd
+        for fd in kwargs.get("pass_fds", ()):
+            fds[fd] = fd
+
+        try:
+            rc = session.call(cwd, kwargs["env"], cmd, fds)
+        except OSError as e:
+            _LOGGER.error("Container session failed: %s", e)
+            session.close()
+            return 1, None
+
+        _session_put(key, session)
+        return rc, None
+
     def _resolv_mounts(self):
+        if self._mounts:
+            return self._mounts
+
         mounts = apkfoundry.MOUNTS.copy()
         for mount in mounts:
             mounts[mount] = self.cdir / "af/config" / mount
             if not mounts[mount].is_symlink():
                 raise RuntimeError(f"af/config/{mount} isn't a symlink")
             mounts[mount] = mounts[mount].resolve(strict=True)
+
+        self._mounts = mounts
         return mounts
 
     def _run_env(self, kwargs):
@@ -254,7 +482,7 @@ class Container:
             "AF_LIBEXEC": "/af/libexec",
         })
 
-    def run_external(self, cmd, skip_mounts=False, **kwargs):
+    def run_external(self, cmd, skip_mounts=False, rw_cache=False, **kwargs):
         args = [
             "--ro-bind", "/", "/",
             "--dev-bind", "/dev", "/dev",
@@ -266,7 +494,8 @@ class Container:
             "--dir", "/tmp/af/libexec",
             "--dir", "/tmp/af/cdir",
             "--ro-bind", apkfoundry.LIBEXECDIR, "/tmp/af/libexec",
-            "--ro-bind-try", apkfoundry.ROOTFS_CACHE, "/tmp/af/rootfs-cache",
+            "--bind-try" if rw_cache else "--ro-bind-try",
+            apkfoundry.ROOTFS_CACHE, "/tmp/af/rootfs-cache",
             "--bind", self.cdir, "/tmp/af/cdir",
         ]
 
@@ -320,7 +549,62 @@ class Container:
         )
         return rc
 
-    def destroy(self):
+    def _destroy_entries(self, want):
+        # Expand the tree breadth-first until there is enough work to
+        # spread over several rm processes, without collecting more
+        # than _DESTROY_MAX paths. Directories which become empty are
+        # removed by the final top-level rm.
+        entries = os.listdir(self.cdir)
+        for _ in range(_DESTROY_DEPTH):
+            if len(entries) >= want:
+                break
+
+            expanded = []
+            for entry in entries:
+                path = self.cdir / entry
+                if path.is_symlink() or not path.is_dir():
+                    expanded.append(entry)
+                    continue
+                try:
+                    children = os.listdir(path)
+                except PermissionError:
+                    expanded.append(entry)
+                    continue
+                if len(expanded) + len(children) > _DESTROY_MAX:
+                    expanded.append(entry)
+                    continue
+                expanded.extend(f"{entry}/{i}" for i in children)
+            entries = expanded
+
+        return entries
+
+    def destroy(self, jobs=None):
+        close_sessions(self.cdir)
+        if not jobs:
+            jobs = os.cpu_count() or 1
+
+        # Remove the second level of the tree with several concurrent
+        # rm processes, then whatever is left at the top level.
+        entries = self._destroy_entries(jobs * 32)
+        if entries:
+            # The paths are given on stdin since there may be too many
+            # for the command line
+            with tempfile.TemporaryFile() as paths:
+                for entry in entries:
+                    paths.write(os.fsencode(entry) + b"\0")
+                paths.seek(0)
+                rc, _ = self.run_external(
+                    # Relative to CWD = cdir
+                    (
+                        "xargs", "-0", "-n", "32", "-P", str(jobs),
+                        "rm", "-rf", "--",
+                    ),
+                    stdin=paths,
+                    skip_mounts=True,
+                )
+            if rc:
+                return rc
+
         children = os.listdir(self.cdir)
         if children:
             rc, _ = self.run_external(
@@ -333,6 +617,57 @@ class Container:
         self.cdir.rmdir()
         return 0
 
+    def destroy_background(self):
+        trash = self.cdir.with_name(f".{self.cdir.name}.{os.getpid()}.rm")
+        os.rename(self.cdir, trash)
+        close_sessions(self.cdir)
+
+        if os.fork():
+            return 0
+
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        rc = 1
+        try:
+            rc = Container(trash, sudo=False).destroy()
+        finally:
+            os._exit(rc)
+
+    def _root_file(self, name):
+        base = self.cdir / _OVERLAY_BASE
+        if not base.is_symlink():
+            return self.cdir / name
+
+        upper = self.cdir / _OVERLAY_UPPER / name
+        if upper.exists() or upper.is_symlink():
+            return upper
+        return base / name
+
+    def _refresh_state(self):
+        state = hashlib.sha256()
+        state.update(f"{self.repo}\0{self.arch}\0".encode("utf-8"))
+
+        try:
+            for path in sorted(self.branchdir.rglob("*")):
+                if not path.is_file():
+                    continue
+                name = str(path.relative_to(self.branchdir))
+                state.update(name.encode("utf-8") + b"\0")
+                state.update(path.read_bytes())
+
+            for name in _REFRESH_OUTPUTS:
+                path = self._root_file(name)
+                state.update(name.encode("utf-8") + b"\0")
+                if path.is_file():
+                    state.update(path.read_bytes())
+        except OSError as e:
+            _LOGGER.debug("Could not compute refresh state: %s", e)
+            return None
+
+        return state.hexdigest()
+
     def refresh(self, setsid=False):
         script = self.branchdir / "refresh"
         if not script.is_file():
@@ -341,11 +676,64 @@ class Container:
         script = script.relative_to(self.branchdir.parent.parent)
         script = Path(apkfoundry.MOUNTS["aportsdir"]) / script
 
+        state_f = self.cdir / _REFRESH_STATE
+        state = self._refresh_state()
+        if state and state_f.is_file() and state_f.read_text() == state:
+            _LOGGER.debug("Refresh inputs unchanged; skipping refresh")
+            return 0
+        if state_f.exists():
+            state_f.unlink()
+
         rc, _ = self.run(
             (str(script),),
             setsid=setsid, skip_refresh=True,
             su=True, net=True, ro_root=False,
         )
+        if rc:
+            return rc
+
+        # Record the state after the refresh so that later changes to
+        # its outputs (e.g. leftover dependencies in the world) are
+        # noticed next time.
+        state = self._refresh_state()
+        if state:
+            state_f.write_text(state)
+
+        return rc
+
+    def reset(self):
+        children = []
+        scratch = [
+            "tmp", "var/tmp",
+            apkfoundry.MOUNTS["builddir"].lstrip("/"),
+        ]
+        repodest = self.cdir / apkfoundry.MOUNTS["repodest"].lstrip("/")
+        if (self.cdir / "af/config/repodest").resolve() == repodest:
+            scratch.append(apkfoundry.MOUNTS["repodest"].lstrip("/"))
+        for i in scratch:
+            if (self.cdir / i).is_dir():
+                children += [f"{i}/{j}" for j in os.listdir(self.cdir / i)]
+
+        if children:
+            rc, _ = self.run_external(
+                # Relative to CWD = cdir
+                ("rm", "-rf", *children),
+                skip_mounts=True,
+            )
+            if rc:
+                return rc
+
+        rc = self.refresh()
+        if rc:
+            return rc
+
+        # Commit the freshly reset world so that packages left behind
+        # by the previous job are removed.
+        rc, _ = self.run(
+            ("/sbin/apk", "upgrade", "--quiet"),
+            skip_refresh=True,
+            su=True, net=True, ro_root=False,
+        )
         return rc
 
     def run(self,
@@ -369,8 +757,23 @@ class Container:
 
         self._run_env(kwargs)
 
-        args = [
-            root_bind, self.cdir, "/",
+        base = self.cdir / _OVERLAY_BASE
+        if not base.is_symlink():
+            args = [root_bind, self.cdir, "/"]
+        elif ro_root:
+            args = [
+                "--overlay-src", base.resolve(strict=True),
+                "--overlay-src", self.cdir / _OVERLAY_UPPER,
+                "--ro-overlay", "/",
+            ]
+        else:
+            args = [
+                "--overlay-src", base.resolve(strict=True),
+                "--overlay", self.cdir / _OVERLAY_UPPER,
+                self.cdir / _OVERLAY_WORK, "/",
+            ]
+
+        args += [
             "--dev-bind", "/dev", "/dev",
             "--proc", "/proc",
             "--ro-bind", str(apkfoundry.LIBEXECDIR), "/af/libexec",
@@ -391,8 +794,8 @@ class Container:
                 "--bind", mounts["repodest"], apkfoundry.MOUNTS["repodest"],
                 "--bind", mounts["srcdest"], apkfoundry.MOUNTS["srcdest"],
                 "--bind", mounts["builddir"], apkfoundry.MOUNTS["builddir"],
-                "--chdir", chdir or apkfoundry.MOUNTS["aportsdir"],
             ]
+            cwd = chdir or apkfoundry.MOUNTS["aportsdir"]
             if (self.cdir / "af/config/cache").exists():
                 args += [
                     "--bind", self.cdir / "af/config/cache", "/etc/apk/cache",
@@ -403,6 +806,8 @@ class Container:
                 args += [
                     "--ro-bind", afterdir, "/af/config/afterdir",
                 ]
+        else:
+            cwd = None
 
         if not skip_refresh and self.refresh():
             return 1, None
@@ -428,13 +833,24 @@ class Container:
                 "APK_FETCH": "apk",
             })
 
-        setarch_f = self.cdir / "af/config/setarch"
-        if setarch_f.is_file():
-            args.extend(["setarch", setarch_f.read_text().strip()])
+        prefix = []
+        if self.setarch:
+            prefix.extend(["setarch", self.setarch])
 
         if kwargs.get("su", False):
-            args.append("/af/libexec/af-su")
+            prefix.append("/af/libexec/af-su")
+
+        cmd = [*prefix, *cmd]
 
+        if self._use_session(setsid, kwargs):
+            return self._session_run(
+                args, cmd,
+                net=net, cwd=str(cwd or "/"),
+                **kwargs,
+            )
+
+        if cwd:
+            args += ["--chdir", cwd]
         args.extend(cmd)
         return self._bwrap(
             args,
@@ -445,12 +861,17 @@ class Container:
 
 def _make_infodir(conf, opts):
     af_info = opts.cdir / "af/config/host"
-    af_info.mkdir(parents=True)
+    af_info.mkdir(parents=True, exist_ok=True)
     af_info = af_info.parent
 
     (af_info / "branch").write_text(opts.branch.strip())
     (af_info / "repo").write_text(conf["repo.default"].strip())
 
+    for name in ("setarch", "cache", *apkfoundry.MOUNTS):
+        name = opts.cdir / "af/config" / name
+        if name.is_symlink() or name.is_file():
+            name.unlink()
+
     if opts.setarch:
         (opts.cdir / "af/config/setarch").write_text(opts.setarch.strip())
 
@@ -477,8 +898,8 @@ def _make_infodir(conf, opts):
             opts.cdir / apkfoundry.MOUNTS[mount].lstrip("/")
         )
 
-    (opts.cdir / "af/libexec").mkdir()
-    (opts.cdir / "af/config/afterdir").mkdir()
+    (opts.cdir / "af/libexec").mkdir(exist_ok=True)
+    (opts.cdir / "af/config/afterdir").mkdir(exist_ok=True)
 
     if opts.cache_apk:
         (opts.cdir / "af/config/cache").symlink_to(opts.cache_apk)
@@ -521,6 +942,12 @@ def _cont_make_args(args):
         configuration, otherwise none)""",
     )
     opts.add_argument("-S", help=argparse.SUPPRESS)
+    opts.add_argument(
+        "--snapshot", action="store_true",
+        help=f"""use a shared, read-only bootstrapped rootfs from
+        {apkfoundry.SNAPSHOTS} with a private writable overlay instead
+        of extracting a new rootfs (default: off)""",
+    )
     opts.add_argument(
         "cdir", metavar="CDIR",
         help="container directory",
@@ -548,7 +975,7 @@ def _cont_make_args(args):
 
     return opts
 
-def cont_make(args):
+def _cont_make_opts(args):
     opts = _cont_make_args(args)
     opts.cdir = Path(opts.cdir)
 
@@ -558,27 +985,174 @@ def cont_make(args):
         opts.setarch = _SITE_CONF.get("setarch", opts.arch, fallback=None)
     if not opts.branch:
         opts.branch = _util.get_branch(opts.aportsdir)
-    branchdir = _util.get_branchdir(opts.aportsdir, opts.branch)
     conf = apkfoundry.proj_conf(opts.aportsdir, opts.branch)
 
+    return opts, conf
+
+def _cont_bootstrap(opts, conf, script):
+    for mount in apkfoundry.MOUNTS.values():
+        (opts.cdir / mount.lstrip("/")).mkdir(parents=True, exist_ok=True)
+
+    _make_infodir(conf, opts)
+
+    cont = Container(opts.cdir)
+    rc = cont.bootstrap(conf, opts.arch, script)
+    if rc:
+        return None
+
+    return cont
+
+def _bootstrap_key(aportsdir, arch, conf, script):
+    """
+    Return a key that changes whenever the rootfs or the bootstrap
+    script (given as a path inside the container) of a container would.
+    """
+    key = hashlib.sha256()
+    sha256 = conf.get("rootfs.sha256." + arch, "").strip()
+    key.update(sha256.encode("utf-8"))
+    for exclusion in conf.getlist("rootfs.exclude", []):
+        key.update(b"\0" + exclusion.encode("utf-8"))
+    key.update(b"\0")
+
+    script = script.relative_to(apkfoundry.MOUNTS["aportsdir"])
+    try:
+        key.update((Path(aportsdir) / script).read_bytes())
+    except OSError:
+        pass
+
+    return key.hexdigest()[:16]
+
+def _bootstrap_script(branchdir):
+    return Path(apkfoundry.MOUNTS["aportsdir"]) \
+        / ".apkfoundry" / branchdir.name / "bootstrap"
+
+def _snapshot_make(opts, conf, script):
+    # A new snapshot is bootstrapped whenever the rootfs or the
+    # bootstrap script changes
+    snapdir = apkfoundry.SNAPSHOTS / (
+        _project_key(opts.aportsdir, opts.branch, opts.arch)
+        + "-" + _bootstrap_key(opts.aportsdir, opts.arch, conf, script)
+    )
+    snapdir.parent.mkdir(parents=True, exist_ok=True)
+
+    lockfile = snapdir.with_name(snapdir.name + ".lock")
+    with open(lockfile, "a", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if (snapdir / _SNAPSHOT_MARKER).is_file():
+            return snapdir
+
+        if snapdir.exists():
+            # Left behind by an interrupted bootstrap
+            rc = Container(snapdir, sudo=False).destroy()
+            if rc:
+                return None
+
+        _LOGGER.info("Bootstrapping snapshot %s...", snapdir)
+        snap_opts = argparse.Namespace(**vars(opts))
+        snap_opts.cdir = snapdir
+        (snapdir / "af").mkdir(parents=True)
+        snapdir.chmod(0o770)
+        cont = _cont_bootstrap(snap_opts, conf, script)
+        if not cont:
+            return None
+
+        (snapdir / _SNAPSHOT_MARKER).touch()
+        return snapdir
+
+def _overlay_make(opts, conf, base):
+    upper = opts.cdir / _OVERLAY_UPPER
+    for mount in ("/af/config", "/af/libexec", "/af/scripts",
+            *apkfoundry.MOUNTS.values()):
+        (upper / mount.lstrip("/")).mkdir(parents=True, exist_ok=True)
+    (opts.cdir / _OVERLAY_WORK).mkdir(parents=True, exist_ok=True)
+
+    for tmp in ("tmp", "var/tmp"):
+        (opts.cdir / tmp).mkdir(parents=True, exist_ok=True)
+        (opts.cdir / tmp).chmod(0o1777)
+    for mount in apkfoundry.MOUNTS.values():
+        (opts.cdir / mount.lstrip("/")).mkdir(parents=True, exist_ok=True)
+
+    _make_infodir(conf, opts)
+    shutil.copytree(base / _ABUILD_USERDIR, opts.cdir / _ABUILD_USERDIR)
+    (opts.cdir / _OVERLAY_BASE).symlink_to(base)
+
+    return Container(opts.cdir)
+
+def cont_make(args):
+    opts, conf = _cont_make_opts(args)
+    branchdir = _util.get_branchdir(opts.aportsdir, opts.branch)
+
     (opts.cdir / "af").mkdir(parents=True, exist_ok=True)
     opts.cdir.chmod(0o770)
 
-    script = branchdir / "bootstrap"
-    if not script.is_file():
+    if not (branchdir / "bootstrap").is_file():
         _LOGGER.error("missing bootstrap script")
         return None
-    script = Path(apkfoundry.MOUNTS["aportsdir"]) \
-        / ".apkfoundry" / script.relative_to(branchdir.parent)
+    script = _bootstrap_script(branchdir)
 
-    for mount in apkfoundry.MOUNTS.values():
-        (opts.cdir / mount.lstrip("/")).mkdir(parents=True, exist_ok=True)
+    if opts.snapshot:
+        base = _snapshot_make(opts, conf, script)
+        if not base:
+            return None
+        return _overlay_make(opts, conf, base)
+
+    return _cont_bootstrap(opts, conf, script)
 
+def cont_reuse(args):
+    opts, conf = _cont_make_opts(args)
     _make_infodir(conf, opts)
 
     cont = Container(opts.cdir)
-    rc = cont.bootstrap(conf, opts.arch, script)
+    rc = cont.reset()
     if rc:
         return None
 
     return cont
+
+def _project_key(aportsdir, branch, arch):
+    aportsdir = Path(aportsdir).resolve()
+    project = hashlib.sha256(str(aportsdir).encode("utf-8")).hexdigest()
+    project = f"{aportsdir.name}-{project[:8]}"
+    return f"{project}.{branch.replace('/', ':')}.{arch}"
+
+def pool_checkout(aportsdir, branch, arch):
+    pooldir = apkfoundry.CONTAINER_POOL / _project_key(aportsdir, branch, arch)
+    pooldir.mkdir(parents=True, exist_ok=True)
+
+    slot = 0
+    while True:
+        lock = (pooldir / f"{slot}.lock").open("a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            slot += 1
+            continue
+
+        _LOGGER.info("Using pooled container %s", pooldir / f"{slot}.af")
+        return pooldir / f"{slot}.af", lock
+
+def pool_key(aportsdir, branch, arch):
+    """
+    Return the key of the rootfs and bootstrap script that pooled
+    containers of the given project, branch, and architecture must have
+    been bootstrapped with in order to be reused.
+    """
+    conf = apkfoundry.proj_conf(aportsdir, branch)
+    script = _bootstrap_script(_util.get_branchdir(aportsdir, branch))
+    return _bootstrap_key(aportsdir, arch, conf, script)
+
+def pool_ready(cdir, key):
+    try:
+        return (Path(cdir) / _POOL_MARKER).read_text(encoding="utf-8") == key
+    except OSError:
+        return False
+
+def pool_checkin(cdir, key):
+    (Path(cdir) / _POOL_MARKER).write_text(key, encoding="utf-8")
+
+def pool_discard(cdir):
+    try:
+        (Path(cdir) / _POOL_MARKER).unlink()
+    except FileNotFoundError:
+        pass
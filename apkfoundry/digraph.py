@@ -4,9 +4,19 @@
 # Based on py-dag 3.0.1
 # https://github.com/thieman/py-dag
 # See LICENSE.MIT for more information.
-import collections # OrderedDict, defaultdict, deque
+import array       # array
+import collections # OrderedDict, defaultdict
+import collections.abc # Mapping
+import concurrent.futures # ThreadPoolExecutor
+import hashlib     # sha256
+import heapq       # heapify, heappop, heappush
+import json        # dump, load
 import logging     # getLogger
-import subprocess  # PIPE, run
+import os          # close, cpu_count, getpid, pipe, replace, scandir, stat
+import subprocess  # PIPE, Popen
+from pathlib import Path
+
+import apkfoundry  # DEPS_CACHE
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -31,6 +41,10 @@ class Digraph:
            Restore the graph to an empty state.
         """
         self.graph = collections.OrderedDict()
+        # Reverse edges: node -> set of nodes on which it depends
+        self.rgraph = {}
+        # Package name -> STARTDIR, filled in by generate_graph
+        self.origins = {}
 
     def size(self):
         """
@@ -50,6 +64,7 @@ class Digraph:
         """
         if node not in self.graph:
             self.graph[node] = set()
+            self.rgraph[node] = set()
 
     def delete_node(self, node):
         """
@@ -60,11 +75,11 @@ class Digraph:
         if node not in self.graph:
             return
 
-        del self.graph[node]
+        for dep_node in self.graph.pop(node):
+            self.rgraph[dep_node].discard(node)
 
-        for edges in self.graph.values():
-            if node in edges:
-                edges.remove(node)
+        for ind_node in self.rgraph.pop(node):
+            self.graph[ind_node].discard(node)
 
     def add_edge(self, ind_node, dep_node):
         """
@@ -79,6 +94,7 @@ class Digraph:
         self.add_node(ind_node)
         self.add_node(dep_node)
         self.graph[ind_node].add(dep_node)
+        self.rgraph[dep_node].add(ind_node)
 
     def delete_edge(self, ind_node, dep_node):
         """
@@ -90,6 +106,7 @@ class Digraph:
             return
 
         self.graph[ind_node].remove(dep_node)
+        self.rgraph[dep_node].remove(ind_node)
 
     def predecessors(self, node):
         """
@@ -98,7 +115,7 @@ class Digraph:
            Returns a list of all predecessors (dependencies) of the given node.
            :rtype: list
         """
-        return [i for i, j in self.graph.items() if node in j]
+        return list(self.rgraph.get(node, ()))
 
     def downstream(self, node):
         """
@@ -115,26 +132,30 @@ class Digraph:
 
         return list(self.graph[node])
 
-    def all_downstreams(self, node):
+    def all_downstreams(self, node, depth=None):
         """
-        .. method:: Digraph.all_downstreams(node)
+        .. method:: Digraph.all_downstreams(node, depth=None)
 
            Returns a set of all nodes ultimately downstream of the given
            node in the dependency graph (i.e. ultimately depend on this
-           node). Raises :exc:`KeyError` if the node doesn't exist.
+           node). If depth is given, only nodes at most that many edges
+           away are returned. Raises :exc:`KeyError` if the node doesn't
+           exist.
 
            :rtype: list
         """
         nodes = [node]
         nodes_seen = set()
-        i = 0
-        while i < len(nodes):
-            downstreams = self.downstream(nodes[i])
-            for downstream_node in downstreams:
-                if downstream_node not in nodes_seen:
-                    nodes_seen.add(downstream_node)
-                    nodes.append(downstream_node)
-            i += 1
+        level = 0
+        while nodes and (depth is None or level < depth):
+            nodes_next = []
+            for cur in nodes:
+                for downstream_node in self.downstream(cur):
+                    if downstream_node not in nodes_seen:
+                        nodes_seen.add(downstream_node)
+                        nodes_next.append(downstream_node)
+            nodes = nodes_next
+            level += 1
         return list(nodes_seen)
 
     def all_leaves(self):
@@ -156,8 +177,7 @@ class Digraph:
 
            :rtype: list
         """
-        dependent_nodes = {k for j in self.graph.values() for k in j}
-        return [i for i in self.graph if i not in dependent_nodes]
+        return [i for i in self.graph if not self.rgraph[i]]
 
     def is_acyclic(self, exc=False):
         """
@@ -183,77 +203,556 @@ class Digraph:
 
     def topological_sort(self):
         """
-        .. method:: Digraph.is_acyclic()
+        .. method:: Digraph.topological_sort()
+
+           Returns a topological sort of the nodes in the graph. Ties
+           between nodes that are ready at the same time are broken in
+           lexicographic order, so the result is deterministic. Raises
+           :exc:`.DAGValidationError` if a dependency cycle is detected.
+
+           :rtype: list
+        """
+        ndeps = {i: len(j) for i, j in self.rgraph.items()}
+        ready = [i for i, j in ndeps.items() if not j]
+        heapq.heapify(ready)
+        tsort = []
+
+        while ready:
+            i = heapq.heappop(ready)
+            tsort.append(i)
+            for j in self.graph[i]:
+                ndeps[j] -= 1
+                if not ndeps[j]:
+                    heapq.heappush(ready, j)
+
+        if len(tsort) != len(self.graph):
+            raise DAGValidationError(self._find_cycle(ndeps))
+
+        return tsort
+
+    def _find_cycle(self, ndeps):
+        # Every node left over from an incomplete topological sort has
+        # at least one left over dependency, so walking dependencies
+        # from any of them must eventually revisit a node.
+        i = min(j for j, n in ndeps.items() if n)
+        path = []
+        seen = {}
+        while i not in seen:
+            seen[i] = len(path)
+            path.append(i)
+            i = min(j for j in self.predecessors(i) if ndeps[j])
+        return (*path[seen[i]:], i)
+
+class _CompactView(collections.abc.Mapping):
+    """
+    Read-only stand-in for :attr:`Digraph.graph` which maps each node of
+    a :class:`CompactDigraph` to the set of its reverse dependencies.
+    """
+
+    __slots__ = ("_digraph",)
+
+    def __init__(self, digraph):
+        self._digraph = digraph
+
+    def __getitem__(self, node):
+        return set(self._digraph.downstream(node))
+
+    def __iter__(self):
+        return iter(self._digraph._live_names())
+
+    def __len__(self):
+        return self._digraph.size()
+
+    def __contains__(self, node):
+        return node in self._digraph._ids
+
+def _csr(n, src, dst):
+    # Counting sort of the (src, dst) pairs by src, then drop
+    # duplicate edges within each row
+    counts = array.array("i", [0]) * (n + 1)
+    for u in src:
+        counts[u + 1] += 1
+    for u in range(n):
+        counts[u + 1] += counts[u]
+
+    targets = array.array("i", [0]) * len(src)
+    pos = counts[:-1]
+    for u, v in zip(src, dst):
+        targets[pos[u]] = v
+        pos[u] += 1
+
+    offsets = array.array("i", [0])
+    rows = array.array("i")
+    for u in range(n):
+        rows.extend(sorted(set(targets[counts[u]:counts[u + 1]])))
+        offsets.append(len(rows))
+
+    return offsets, rows
+
+class CompactDigraph(Digraph):
+    """
+    .. class:: CompactDigraph()
+
+       Construct a new directed graph with no nodes or edges. This has
+       the same API as :class:`Digraph`, but nodes are interned to
+       integer IDs and edges are stored in compressed sparse row arrays
+       in both directions, which uses much less memory for large
+       graphs. The :attr:`graph` attribute is a read-only mapping.
+
+       Added edges are buffered and merged into the arrays the next time
+       the graph is queried, so graphs should be built up completely
+       before being examined.
+    """
+
+    def reset_graph(self):
+        """
+        .. method:: CompactDigraph.reset_graph()
+
+           Restore the graph to an empty state.
+        """
+        self._names = []
+        self._ids = {}
+        self._alive = bytearray()
+        self._pending = (array.array("i"), array.array("i"))
+        self._fwd = (array.array("i", [0]), array.array("i"))
+        self._rev = (array.array("i", [0]), array.array("i"))
+        self._rank = array.array("i")
+        self._dirty = False
+        self.origins = {}
+
+    @property
+    def graph(self):
+        return _CompactView(self)
+
+    def _live_names(self):
+        return [i for i, j in zip(self._names, self._alive) if j]
+
+    def _compact(self):
+        if not self._dirty:
+            return
+
+        n = len(self._names)
+        src = array.array("i")
+        dst = array.array("i")
+        for u in range(len(self._fwd[0]) - 1):
+            for v in self._row(self._fwd, u):
+                src.append(u)
+                dst.append(v)
+        for u, v in zip(*self._pending):
+            if self._alive[u] and self._alive[v]:
+                src.append(u)
+                dst.append(v)
+
+        self._fwd = _csr(n, src, dst)
+        self._rev = _csr(n, dst, src)
+        self._pending = (array.array("i"), array.array("i"))
+
+        self._rank = array.array("i", [0]) * n
+        by_name = sorted(range(n), key=self._names.__getitem__)
+        for rank, u in enumerate(by_name):
+            self._rank[u] = rank
+
+        self._dirty = False
+
+    def _row(self, csr, u):
+        if not self._alive[u]:
+            return []
+        offsets, rows = csr
+        return [
+            v for v in rows[offsets[u]:offsets[u + 1]]
+            if v >= 0 and self._alive[v]
+        ]
+
+    def size(self):
+        """
+        .. method:: CompactDigraph.size()
+
+           Return the number of nodes in the graph.
+
+           :rtype: int
+        """
+        return len(self._ids)
+
+    def add_node(self, node):
+        """
+        .. method:: CompactDigraph.add_node(node)
+
+           Add the given node to the graph.
+        """
+        if node in self._ids:
+            return
+
+        # Deleted nodes are not reused so that their old edges stay dead
+        self._ids[node] = len(self._names)
+        self._names.append(node)
+        self._alive.append(1)
+        self._dirty = True
+
+    def delete_node(self, node):
+        """
+        .. method:: CompactDigraph.delete_node(node)
+
+           Deletes the given node and all edges referencing it.
+        """
+        u = self._ids.pop(node, None)
+        if u is None:
+            return
+        self._alive[u] = 0
+
+    def add_edge(self, ind_node, dep_node):
+        """
+        .. method:: CompactDigraph.add_edge(ind_node, dep_node)
+
+           Add an edge between the specified nodes. See
+           :meth:`Digraph.add_edge`.
+        """
+        self.add_node(ind_node)
+        self.add_node(dep_node)
+        self._pending[0].append(self._ids[ind_node])
+        self._pending[1].append(self._ids[dep_node])
+        self._dirty = True
+
+    def delete_edge(self, ind_node, dep_node):
+        """
+        .. method:: CompactDigraph.delete_edge(ind_node, dep_node)
+
+           Delete an edge from the graph.
+        """
+        if ind_node not in self._ids or dep_node not in self._ids:
+            return
+        self._compact()
+
+        u = self._ids[ind_node]
+        v = self._ids[dep_node]
+        for (offsets, rows), i, j in ((self._fwd, u, v), (self._rev, v, u)):
+            for k in range(offsets[i], offsets[i + 1]):
+                if rows[k] == j:
+                    rows[k] = -1
+
+    def predecessors(self, node):
+        """
+        .. method:: CompactDigraph.predecessors(node)
+
+           Returns a list of all predecessors (dependencies) of the given node.
+           :rtype: list
+        """
+        if node not in self._ids:
+            return []
+        self._compact()
+        return [self._names[v] for v in self._row(self._rev, self._ids[node])]
+
+    def downstream(self, node):
+        """
+        .. method:: CompactDigraph.downstream(node)
+
+           Returns a list of all first level reverse dependencies of the
+           given node. Raises :exc:`KeyError` if the node doesn't exist.
+
+           :rtype: list
+        """
+        if node not in self._ids:
+            raise KeyError(f"Node '{node}' is not in graph")
+        self._compact()
+        return [self._names[v] for v in self._row(self._fwd, self._ids[node])]
+
+    def all_downstreams(self, node, depth=None):
+        """
+        .. method:: CompactDigraph.all_downstreams(node, depth=None)
+
+           Returns a list of all nodes ultimately downstream of the given
+           node in the dependency graph. If depth is given, only nodes at
+           most that many edges away are returned. Raises
+           :exc:`KeyError` if the node doesn't exist.
+
+           :rtype: list
+        """
+        if node not in self._ids:
+            raise KeyError(f"Node '{node}' is not in graph")
+        self._compact()
+
+        seen = bytearray(len(self._names))
+        todo = [self._ids[node]]
+        nodes = []
+        level = 0
+        while todo and (depth is None or level < depth):
+            todo_next = []
+            for u in todo:
+                for v in self._row(self._fwd, u):
+                    if not seen[v]:
+                        seen[v] = 1
+                        nodes.append(self._names[v])
+                        todo_next.append(v)
+            todo = todo_next
+            level += 1
+        return nodes
+
+    def all_leaves(self):
+        """
+        .. method:: CompactDigraph.all_leaves()
 
-           Returns a topological sort of the nodes in the graph. Results
-           are not deterministic. Raises :exc:`.DAGValidationError` if a
-           dependency cycle is detected.
+           Return a list of all leaves (nodes with no downstreams /
+           reverse dependencies).
 
            :rtype: list
         """
-        nodes = {i: 0 for i in self.graph}
-        unvisited = [i for i, visited in nodes.items() if visited == 0]
-        tsort = collections.deque()
+        self._compact()
+        return [
+            self._names[u] for u in self._ids.values()
+            if not self._row(self._fwd, u)
+        ]
 
-        def visit(i, *ctx):
-            if nodes[i] == 1:
-                raise DAGValidationError((i, *ctx))
+    def ind_nodes(self):
+        """
+        .. method:: CompactDigraph.ind_nodes()
 
-            if nodes[i] == 0:
-                nodes[i] = 1
-                for j in self.graph[i]:
-                    visit(j, i, *ctx)
-                nodes[i] = 2
-                tsort.appendleft(i)
+           Returns a list of all nodes in the graph with no dependencies.
 
-        while unvisited:
-            i = unvisited.pop()
-            visit(i)
-            unvisited = [i for i, visited in nodes.items() if visited == 0]
+           :rtype: list
+        """
+        self._compact()
+        return [
+            self._names[u] for u in self._ids.values()
+            if not self._row(self._rev, u)
+        ]
+
+    def topological_sort(self):
+        """
+        .. method:: CompactDigraph.topological_sort()
+
+           Returns a topological sort of the nodes in the graph. See
+           :meth:`Digraph.topological_sort`.
+
+           :rtype: list
+        """
+        self._compact()
+        by_rank = array.array("i", [0]) * len(self._names)
+        for u, rank in enumerate(self._rank):
+            by_rank[rank] = u
+
+        ndeps = {u: len(self._row(self._rev, u)) for u in self._ids.values()}
+        ready = [self._rank[u] for u, n in ndeps.items() if not n]
+        heapq.heapify(ready)
+        tsort = []
+
+        while ready:
+            u = by_rank[heapq.heappop(ready)]
+            tsort.append(self._names[u])
+            for v in self._row(self._fwd, u):
+                ndeps[v] -= 1
+                if not ndeps[v]:
+                    heapq.heappush(ready, self._rank[v])
+
+        if len(tsort) != len(ndeps):
+            ndeps = {self._names[u]: n for u, n in ndeps.items()}
+            raise DAGValidationError(self._find_cycle(ndeps))
 
         return tsort
 
-def generate_graph(conf, *, use_ignore=True, skip_check=False, cont=None):
-    deps_ignore = conf.getmaplist("deps.ignore") if use_ignore else {}
-    deps_map = conf.getmap("deps.map")
-    repos = conf.getmaplist("repo.arch")
+_DEPS_CACHE_VERSION = 1
+# Don't bother starting another af-deps for fewer APKBUILDs than this
+_MIN_SHARD_SIZE = 32
 
-    graph = Digraph()
-    args = ["af-deps"]
-    if skip_check:
-        args.append("-s")
-    args += repos.keys()
+def _parse_af_deps(lines):
+    records = collections.defaultdict(list)
+    for line in lines:
+        line = line.strip().split(maxsplit=2)
+        if not line:
+            continue
+        if len(line) != 3 or line[0] not in ("o", "d", "m"):
+            _LOGGER.error("invalid af-deps output: %r", line)
+            return None
 
-    if cont:
-        args[0] = "/af/libexec/af-deps"
-        rc, proc = cont.run(
-            args,
+        # Origin records name the startdir last, all others first
+        startdir = line[2] if line[0] == "o" else line[1]
+        records[startdir].append(line)
+
+    return records
+
+def _af_deps_cont(args, cont):
+    args = ["/af/libexec/af-deps", *args]
+    read_fd, write_fd = os.pipe()
+
+    def run():
+        try:
+            rc, _ = cont.run(
+                args,
+                stdout=write_fd,
+                skip_refresh=True, skip_sudo=True,
+            )
+        finally:
+            os.close(write_fd)
+        return rc
+
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        future = pool.submit(run)
+        # Closing the read end early (e.g. on invalid output) makes
+        # af-deps die from SIGPIPE instead of evaluating everything else
+        with open(read_fd, encoding="utf-8") as f:
+            records = _parse_af_deps(f)
+        rc = future.result()
+
+    return rc, records
+
+def _af_deps_host(args):
+    with subprocess.Popen(
+            ["af-deps", *args],
             stdout=subprocess.PIPE,
             encoding="utf-8",
-            skip_refresh=True, skip_sudo=True,
-        )
+        ) as proc:
+        records = _parse_af_deps(proc.stdout)
+        if records is None:
+            proc.kill()
+
+    return proc.returncode, records
+
+def _af_deps(args, cont):
+    if cont:
+        rc, records = _af_deps_cont(args, cont)
     else:
-        proc = subprocess.run(
-            args,
-            stdout=subprocess.PIPE,
-            encoding="utf-8",
-        )
-        rc = proc.returncode
+        rc, records = _af_deps_host(args)
 
+    if records is None:
+        return None
     if rc != 0:
         _LOGGER.error("af-deps failed with status %d", rc)
         return None
 
-    origins = {}
-    deps = collections.defaultdict(list)
-    for line in proc.stdout.split("\n"):
-        line = line.strip().split(maxsplit=2)
-        if not line:
+    return records
+
+def _scan_apkbuilds(aportsdir, repos):
+    apkbuilds = {}
+    for repo in repos:
+        try:
+            entries = sorted(os.scandir(aportsdir / repo), key=lambda i: i.name)
+        except (FileNotFoundError, NotADirectoryError):
             continue
-        if len(line) != 3:
-            _LOGGER.error("invalid af-deps output: %r", line)
+
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                st = os.stat(Path(entry.path) / "APKBUILD")
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            apkbuilds[f"{repo}/{entry.name}"] = [st.st_mtime_ns, st.st_size]
+
+    return apkbuilds
+
+def _deps_cache_file(aportsdir, arch, skip_check):
+    key = "\0".join((
+        str(aportsdir.resolve()),
+        arch or "",
+        "skip-check" if skip_check else "",
+    ))
+    key = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return apkfoundry.DEPS_CACHE / f"{key}.json"
+
+def _load_deps_cache(cache_file):
+    try:
+        with open(cache_file, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if cache.get("version") != _DEPS_CACHE_VERSION:
+        return {}
+    return cache.get("startdirs", {})
+
+def _save_deps_cache(cache_file, startdirs):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(
+            {"version": _DEPS_CACHE_VERSION, "startdirs": startdirs},
+            f, separators=(",", ":"),
+        )
+    os.replace(tmp, cache_file)
+
+def _af_deps_sharded(startdirs, skip_check, cont, jobs):
+    args = ["-p"]
+    if skip_check:
+        args.append("-s")
+
+    if not jobs:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(startdirs) // _MIN_SHARD_SIZE))
+    # Stripe the shards so that each gets a similar mix of repositories
+    shards = [startdirs[i::jobs] for i in range(jobs)]
+    if jobs == 1:
+        return _af_deps(args + shards[0], cont)
+
+    _LOGGER.debug("Evaluating APKBUILDs using %d workers", jobs)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        results = list(pool.map(
+            lambda shard: _af_deps(args + shard, cont), shards,
+        ))
+    if any(i is None for i in results):
+        return None
+
+    records = collections.defaultdict(list)
+    for result in results:
+        for startdir, lines in result.items():
+            records[startdir].extend(lines)
+    return records
+
+def _get_records(repos, *, skip_check=False, cont=None, jobs=None):
+    if cont:
+        aportsdir = cont.cdir / "af/config/aportsdir"
+        arch = cont.arch
+    else:
+        aportsdir = Path.cwd()
+        arch = None
+
+    apkbuilds = _scan_apkbuilds(aportsdir, repos)
+    cache_file = _deps_cache_file(aportsdir, arch, skip_check)
+    cache = _load_deps_cache(cache_file)
+
+    stale = [
+        startdir for startdir, key in apkbuilds.items()
+        if cache.get(startdir, {}).get("key") != key
+    ]
+    _LOGGER.debug(
+        "%d of %d APKBUILDs need to be evaluated",
+        len(stale), len(apkbuilds),
+    )
+
+    if stale:
+        records = _af_deps_sharded(stale, skip_check, cont, jobs)
+        if records is None:
             return None
 
+        for startdir in stale:
+            cache[startdir] = {
+                "key": apkbuilds[startdir],
+                "records": records.get(startdir, []),
+            }
+
+    # Drop entries for APKBUILDs that no longer exist
+    cache = {startdir: cache[startdir] for startdir in apkbuilds}
+    if stale or len(cache) != len(apkbuilds):
+        try:
+            _save_deps_cache(cache_file, cache)
+        except OSError as e:
+            _LOGGER.warning("could not save dependency cache: %s", e)
+
+    return [line for i in cache.values() for line in i["records"]]
+
+def generate_graph(conf, *, use_ignore=True, skip_check=False, cont=None,
+                   jobs=None, compact=False):
+    deps_ignore = conf.getmaplist("deps.ignore") if use_ignore else {}
+    deps_map = conf.getmap("deps.map")
+    repos = conf.getmaplist("repo.arch")
+
+    graph = CompactDigraph() if compact else Digraph()
+    records = _get_records(
+        repos.keys(), skip_check=skip_check, cont=cont, jobs=jobs,
+    )
+    if records is None:
+        return None
+
+    origins = graph.origins
+    deps = collections.defaultdict(list)
+    for line in records:
         # Origin: $1 comes from startdir $2
         if line[0] == "o":
             name = line[1]
@@ -268,9 +767,6 @@ def generate_graph(conf, *, use_ignore=True, skip_check=False, cont=None):
         # Masked: startdir $1 is masked by $arch/$options
         elif line[0] == "m":
             _LOGGER.warning("masked: %s", line[1])
-        else:
-            _LOGGER.error("invalid af-deps output: %r", line)
-            return None
 
     missing = set()
     for rdep, names in deps.items():
@@ -0,0 +1,275 @@
+/*
+ * SPDX-License-Identifier: GPL-2.0-only
+ * Copyright (c) 2021 Max Rees
+ * See LICENSE for more information.
+ */
+#define PROG "af-session"
+#define USAGE PROG " FD"
+#define BUF_SIZE 65536
+#define MAX_FDS 16
+/* Received FDs are moved at or above this before being dup2'd */
+#define FD_BASE 64
+
+#define _XOPEN_SOURCE 700
+#define _GNU_SOURCE     /* MSG_CMSG_CLOEXEC */
+#include <err.h>        /* err, errx, warnx              */
+#include <errno.h>      /* errno, EINTR                  */
+#include <fcntl.h>      /* fcntl, F_DUPFD_CLOEXEC, ...   */
+#include <poll.h>       /* poll, POLLIN                  */
+#include <signal.h>     /* sigaction, SIGCHLD            */
+#include <stdlib.h>     /* exit, strtol                  */
+#include <string.h>     /* memcpy, memset, strlen        */
+#include <sys/socket.h>
+#include <sys/wait.h>   /* waitpid, W*                   */
+#include <unistd.h>     /* chdir, close, dup2, execvp... */
+
+/*
+ * Each request is a single SOCK_SEQPACKET message. It starts with a
+ * header of native ints:
+ *
+ *     setsid, nfds, target[0] ... target[nfds - 1]
+ *
+ * followed by NUL-terminated strings:
+ *
+ *     cwd, ENV=VAR ..., "", argv[0], argv[1], ...
+ *
+ * and carries nfds file descriptors which are installed as target[i]
+ * in the child. The reply is the exit status as a single int.
+ */
+
+#define FATAL_IF(what, why) \
+	errno = 0; \
+	if (what) \
+	err(3, "%s", why);
+
+extern char **environ;
+
+static int sigchld_pipe[2];
+
+static void usage(void) {
+	errx(1, "usage: %s", USAGE);
+}
+
+static void on_sigchld(int sig) {
+	int saved_errno = errno;
+	(void) sig;
+	(void) write(sigchld_pipe[1], "", 1);
+	errno = saved_errno;
+}
+
+static char **split_strings(char **p, char *end, int *count) {
+	char **strings;
+	char *start = *p;
+	int n = 0;
+
+	while (*p < end && **p != '\0') {
+		*p += strlen(*p) + 1;
+		n++;
+	}
+
+	strings = calloc(n + 1, sizeof(char *));
+	FATAL_IF(strings == 0, "calloc");
+
+	for (n = 0; start < *p; n++) {
+		strings[n] = start;
+		start += strlen(start) + 1;
+	}
+
+	*count = n;
+	return strings;
+}
+
+static void child(int setsid_, int nfds, int *targets, int *fds,
+		char *cwd, char **envp, char **argv) {
+	int i, moved[MAX_FDS];
+
+	if (setsid_ && setsid() == -1)
+		err(127, "setsid");
+
+	for (i = 0; i < nfds; i++) {
+		moved[i] = fcntl(fds[i], F_DUPFD_CLOEXEC, FD_BASE);
+		if (moved[i] == -1)
+			err(127, "fcntl");
+	}
+	for (i = 0; i < nfds; i++) {
+		if (dup2(moved[i], targets[i]) == -1)
+			err(127, "dup2");
+	}
+
+	if (chdir(cwd))
+		err(127, "chdir: %s", cwd);
+
+	environ = envp;
+	execvp(argv[0], argv);
+	err(127, "execvp: %s", argv[0]);
+}
+
+static int wait_child(int sock_fd, pid_t pid) {
+	struct pollfd pfds[2];
+	char c;
+	int status;
+	pid_t ret;
+
+	pfds[0].fd = sock_fd;
+	pfds[0].events = POLLIN;
+	pfds[1].fd = sigchld_pipe[0];
+	pfds[1].events = POLLIN;
+
+	for (;;) {
+		ret = waitpid(pid, &status, WNOHANG);
+		FATAL_IF(ret == -1, "waitpid");
+		if (ret == pid)
+			break;
+
+		if (poll(pfds, 2, -1) == -1) {
+			if (errno == EINTR)
+				continue;
+			err(3, "poll");
+		}
+
+		/*
+		 * Nothing may be sent while a command is running, so this
+		 * means the controlling process went away. Exiting tears
+		 * down the whole PID namespace including the command.
+		 */
+		if (pfds[0].revents)
+			exit(1);
+
+		if (pfds[1].revents)
+			while (read(sigchld_pipe[0], &c, 1) == 1);
+	}
+
+	if (WIFEXITED(status))
+		return WEXITSTATUS(status);
+	if (WIFSIGNALED(status))
+		return 128 + WTERMSIG(status);
+	return 255;
+}
+
+static int handle(int sock_fd, char *buf, ssize_t len, struct msghdr *msg) {
+	struct cmsghdr *cmsg;
+	int fds[MAX_FDS], header[2 + MAX_FDS];
+	int i, nfds, nrecv = 0, nenv, nargv, rc = 255;
+	char *p, *end, *cwd, **envp = 0, **argv = 0;
+	pid_t pid;
+
+	for (cmsg = CMSG_FIRSTHDR(msg); cmsg; cmsg = CMSG_NXTHDR(msg, cmsg)) {
+		if (cmsg->cmsg_level != SOL_SOCKET || cmsg->cmsg_type != SCM_RIGHTS)
+			continue;
+		nrecv = (cmsg->cmsg_len - CMSG_LEN(0)) / sizeof(int);
+		memcpy(fds, CMSG_DATA(cmsg), nrecv * sizeof(int));
+	}
+
+	if (msg->msg_flags & (MSG_TRUNC | MSG_CTRUNC)) {
+		warnx("request too large");
+		goto out;
+	}
+
+	if ((size_t) len < 2 * sizeof(int)) {
+		warnx("request too short");
+		goto out;
+	}
+	memcpy(header, buf, 2 * sizeof(int));
+	nfds = header[1];
+	if (nfds != nrecv || nfds > MAX_FDS
+			|| (size_t) len < (2 + nfds) * sizeof(int)) {
+		warnx("invalid file descriptor count");
+		goto out;
+	}
+	memcpy(header, buf, (2 + nfds) * sizeof(int));
+	for (i = 0; i < nfds; i++) {
+		if (header[2 + i] < 0 || header[2 + i] >= FD_BASE) {
+			warnx("invalid target file descriptor %d", header[2 + i]);
+			goto out;
+		}
+	}
+
+	p = buf + (2 + nfds) * sizeof(int);
+	end = buf + len;
+	if (end[-1] != '\0') {
+		warnx("request is not NUL-terminated");
+		goto out;
+	}
+
+	cwd = p;
+	p += strlen(p) + 1;
+	envp = split_strings(&p, end, &nenv);
+	p++;
+	argv = split_strings(&p, end, &nargv);
+	if (p > end || nargv == 0) {
+		warnx("no command given");
+		goto out;
+	}
+
+	pid = fork();
+	FATAL_IF(pid == -1, "fork");
+	if (pid == 0) {
+		close(sock_fd);
+		child(header[0], nfds, header + 2, fds, cwd, envp, argv);
+	}
+
+	for (i = 0; i < nrecv; i++)
+		close(fds[i]);
+	nrecv = 0;
+	rc = wait_child(sock_fd, pid);
+
+out:
+	for (i = 0; i < nrecv; i++)
+		close(fds[i]);
+	free(envp);
+	free(argv);
+	return rc;
+}
+
+int main(int argc, char *argv[]) {
+	static char buf[BUF_SIZE];
+	unsigned char cbuf[CMSG_SPACE(MAX_FDS * sizeof(int))];
+	struct sigaction sa;
+	struct iovec iov;
+	struct msghdr msg;
+	ssize_t len;
+	int sock_fd, rc;
+
+	if (argc != 2)
+		usage();
+
+	errno = 0;
+	sock_fd = (int) strtol(argv[1], 0, 10);
+	if (errno != 0)
+		errx(1, "%s is not a valid FD", argv[1]);
+	FATAL_IF(fcntl(sock_fd, F_SETFD, FD_CLOEXEC) == -1, "fcntl");
+
+	FATAL_IF(pipe(sigchld_pipe) == -1, "pipe");
+	FATAL_IF(fcntl(sigchld_pipe[0], F_SETFD, FD_CLOEXEC) == -1, "fcntl");
+	FATAL_IF(fcntl(sigchld_pipe[1], F_SETFD, FD_CLOEXEC) == -1, "fcntl");
+	FATAL_IF(fcntl(sigchld_pipe[0], F_SETFL, O_NONBLOCK) == -1, "fcntl");
+	FATAL_IF(fcntl(sigchld_pipe[1], F_SETFL, O_NONBLOCK) == -1, "fcntl");
+
+	memset(&sa, 0, sizeof(sa));
+	sa.sa_handler = on_sigchld;
+	sa.sa_flags = SA_RESTART | SA_NOCLDSTOP;
+	FATAL_IF(sigaction(SIGCHLD, &sa, 0) == -1, "sigaction");
+
+	for (;;) {
+		iov.iov_base = buf;
+		iov.iov_len = BUF_SIZE;
+
+		memset(&msg, 0, sizeof(msg));
+		msg.msg_iov = &iov;
+		msg.msg_iovlen = 1;
+		msg.msg_control = cbuf;
+		msg.msg_controllen = sizeof(cbuf);
+
+		len = recvmsg(sock_fd, &msg, MSG_CMSG_CLOEXEC);
+		if (len == -1 && errno == EINTR)
+			continue;
+		FATAL_IF(len == -1, "recvmsg");
+		if (len == 0)
+			break;
+
+		rc = handle(sock_fd, buf, len, &msg);
+		FATAL_IF(send(sock_fd, &rc, sizeof(rc), 0) == -1, "send");
+	}
+
+	return 0;
+}
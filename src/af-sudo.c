@@ -6,7 +6,8 @@
 #define PROG "af-sudo"
 #define USAGE PROG " COMMAND [ARGS ...]"
 #define BUF_SIZE 4096
-#define NUM_FDS 3
+/* stdin, stdout, stderr, and the socket to send the reply to */
+#define NUM_FDS 4
 
 #define _XOPEN_SOURCE 700
 #include <err.h>        /* err, errx      */
@@ -16,7 +17,7 @@
 #include <stdio.h>      /* snprintf       */
 #include <string.h>     /* memcpy, strcmp */
 #include <sys/socket.h>
-#include <unistd.h>     /* *_FILENO       */
+#include <unistd.h>     /* close, *_FILENO */
 
 #define FATAL_IF(what, why) \
 	errno = 0; \
@@ -85,17 +86,21 @@ static void send_cmd(int sock_fd, int my_fds[NUM_FDS], int argc, int start, char
 
 static int recv_retcode(int sock_fd) {
 	char buf[BUF_SIZE];
+	ssize_t len;
 	int *rc;
 
-	FATAL_IF(recv(sock_fd, buf, BUF_SIZE, 0) == -1, "recv_retcode recv");
+	len = recv(sock_fd, buf, BUF_SIZE, 0);
+	FATAL_IF(len == -1, "recv_retcode recv");
+	if ((size_t) len < sizeof(int))
+		errx(3, "recv_retcode: no reply received");
 	rc = (int *) buf;
 	return *rc;
 }
 
 int main(int argc, char *argv[]) {
-	int start, sock_fd;
+	int start, sock_fd, reply_fds[2];
 	char *cmd;
-	int my_fds[NUM_FDS] = {STDIN_FILENO, STDOUT_FILENO, STDERR_FILENO};
+	int my_fds[NUM_FDS] = {STDIN_FILENO, STDOUT_FILENO, STDERR_FILENO, -1};
 
 	if (argc == 0)
 		usage();
@@ -111,6 +116,14 @@ int main(int argc, char *argv[]) {
 
 	sock_fd = fd_from_env("AF_SUDO_FD");
 
+	/*
+	 * Each request gets its own reply socket so that several requests
+	 * can be in flight over AF_SUDO_FD at the same time.
+	 */
+	FATAL_IF(socketpair(AF_UNIX, SOCK_SEQPACKET, 0, reply_fds) == -1, "socketpair");
+	my_fds[3] = reply_fds[1];
+
 	send_cmd(sock_fd, my_fds, argc, start, argv);
-	return recv_retcode(sock_fd);
+	close(reply_fds[1]);
+	return recv_retcode(reply_fds[0]);
 }
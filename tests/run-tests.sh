@@ -3,7 +3,7 @@
 # Copyright (c) 2020 Max Rees
 # See LICENSE for more information.
 export PATH="$PWD/bin:$PATH"
-export PYTHONPATH="$PWD:$PYTHONPATH"
+export PYTHONPATH="$PWD:$PWD/tests:$PYTHONPATH"
 
 export AF_TESTDIR="tests/tmp"
 export AF_CONFIG="$AF_TESTDIR/config"
@@ -0,0 +1,45 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+"""
+Helpers shared by the Python tests. tests/run-tests.sh puts this
+directory on PYTHONPATH.
+"""
+import random # Random
+import sys    # exit
+
+import apkfoundry.digraph # Digraph
+
+_failed = False
+
+def check(name, cond):
+    """
+    Print PASS or FAIL followed by name depending on cond, and remember
+    the failure for done().
+    """
+    global _failed
+    print(("PASS" if cond else "FAIL"), name)
+    if not cond:
+        _failed = True
+    return cond
+
+def done():
+    """Exit with a failure status if any check failed."""
+    sys.exit(1 if _failed else 0)
+
+def synthetic_graph(cls=apkfoundry.digraph.Digraph, nodes=10000, edges=3):
+    """
+    Return a reproducible random dependency graph in which each node
+    depends on up to the given number of earlier nodes.
+    """
+    rng = random.Random(0)
+    graph = cls()
+    for i in range(nodes):
+        node = f"main/pkg{i:05d}"
+        graph.add_node(node)
+        for _ in range(edges):
+            if not i:
+                break
+            dep = f"main/pkg{rng.randrange(i):05d}"
+            graph.add_edge(dep, node)
+    return graph